@@ -0,0 +1,331 @@
+from .fakepigpiod import FakePigpiod
+from .fakebroker import FakeBroker
+
+from threading import Condition
+import argparse
+import json
+import os
+import platform
+import random
+import signal
+import subprocess
+import sys
+import time
+
+
+DOOR_TOPIC = 'bench/door'
+DOOR_GPIO = {'top': 17, 'bot': 27, 'act': 22}
+
+PRESSURE_TOPIC = 'bench/pressure'
+PRESSURE_I2C = {'bus': 1, 'addr': 40}
+
+# Each transition moves a single switch, as a real door does.
+DOOR_CYCLE = [
+    ('bot',1,'opening'),
+    ('top',0,'open'),
+    ('top',1,'closing'),
+    ('bot',0,'closed')
+]
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Bench():
+
+    def __init__(self):
+        self.pigpiod = FakePigpiod()
+        self.broker = FakeBroker()
+        self.pigpiod.start()
+        self.broker.start()
+
+        self.__condition = Condition()
+        self.__messages = []
+        self.__writes = []
+        self.broker.on_publish(self.__on_publish)
+        self.pigpiod.on_write(self.__on_write)
+
+
+    def __on_publish(self,topic,payload,qos,retain):
+        with self.__condition:
+            self.__messages.append((time.perf_counter(),topic,payload))
+            self.__condition.notify_all()
+
+
+    def __on_write(self,pin,level):
+        with self.__condition:
+            self.__writes.append((time.perf_counter(),pin,level))
+            self.__condition.notify_all()
+
+
+    def clear(self):
+        with self.__condition:
+            self.__messages = []
+            self.__writes = []
+
+
+    def wait_message(self,topic,payload,timeout=5.0) -> float:
+        deadline = time.monotonic() + timeout
+        with self.__condition:
+            while True:
+                for index, (when, _topic, _payload) in enumerate(self.__messages):
+                    if _topic == topic and (payload is None or _payload == payload):
+                        del self.__messages[:index + 1]
+                        return when
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f'no publish of {payload} to {topic}')
+                self.__condition.wait(remaining)
+
+
+    def wait_write(self,pin,level,timeout=5.0) -> float:
+        deadline = time.monotonic() + timeout
+        with self.__condition:
+            while True:
+                for index, (when, _pin, _level) in enumerate(self.__writes):
+                    if _pin == pin and _level == level:
+                        del self.__writes[:index + 1]
+                        return when
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f'no write of {level} to gpio {pin}')
+                self.__condition.wait(remaining)
+
+
+    def messages(self) -> list:
+        with self.__condition:
+            return list(self.__messages)
+
+
+    def config(self,sensors,**extra) -> dict:
+        config = {
+            'mqtt': {'clientid': 'bench', 'host': self.broker.host, 'port': self.broker.port},
+            'gpio': {'host': self.pigpiod.host, 'port': self.pigpiod.port},
+            'logger': {'version': 1, 'root': {'level': 'WARNING'}},
+            'sensors': sensors
+        }
+        config.update(extra)
+        return config
+
+
+    # Runs the application as it is deployed, in its own process.
+    def garage(self,config) -> subprocess.Popen:
+        return subprocess.Popen(
+            [sys.executable,'-c','from garage.garage import main; main()','--config',json.dumps(config)],
+            cwd=ROOT,
+            env=dict(os.environ,PYTHONPATH=ROOT))
+
+
+    def close(self):
+        self.broker.close()
+        self.pigpiod.close()
+
+
+def stop(process):
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def cpu_seconds(pid) -> float:
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')',1)[1].split()
+    # utime and stime are the 14th and 15th fields, counted from the pid.
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def summary(values) -> dict:
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+
+    def percentile(p):
+        return values[min(len(values) - 1,int(round(p * (len(values) - 1))))]
+
+    return {
+        'count': len(values),
+        'mean_ms': round(sum(values) / len(values) * 1000,3),
+        'p50_ms': round(percentile(0.5) * 1000,3),
+        'p90_ms': round(percentile(0.9) * 1000,3),
+        'p99_ms': round(percentile(0.99) * 1000,3),
+        'max_ms': round(values[-1] * 1000,3)
+    }
+
+
+def door_sensor(mode) -> dict:
+    return {'garagedoor': {'topic': DOOR_TOPIC, 'rate': 3600, 'mode': mode, 'gpio': dict(DOOR_GPIO)}}
+
+
+def pressure_sensor(oversample=None,frames=None) -> dict:
+    sensor = {
+        'topic': PRESSURE_TOPIC,
+        'rate': 1,
+        'i2c': dict(PRESSURE_I2C),
+        'press': {'max': 15.748, 'min': -15.748}
+    }
+    if oversample is not None:
+        sensor['oversample'] = {'rate': oversample}
+    if frames is not None:
+        sensor['i2c']['frames'] = frames
+    return {'sm9514': sensor}
+
+
+def pressure_device(count) -> bytes:
+    # Status ok with counts wandering around mid scale.
+    counts = 8192 + random.randint(-64,64)
+    return bytes([counts >> 8,counts & 0xFF,0,0])
+
+
+def start_door(bench,mode) -> subprocess.Popen:
+    bench.pigpiod.set_level(DOOR_GPIO['top'],1)
+    bench.pigpiod.set_level(DOOR_GPIO['bot'],0)
+    bench.clear()
+    process = bench.garage(bench.config([door_sensor(mode)]))
+    bench.wait_message(DOOR_TOPIC,b'closed',timeout=20)
+    return process
+
+
+def door_latency(bench,mode,iterations) -> dict:
+    process = start_door(bench,mode)
+    latencies = []
+    try:
+        for index in range(iterations):
+            pin, level, state = DOOR_CYCLE[index % len(DOOR_CYCLE)]
+            # A random pause keeps the edges from locking onto a poll period.
+            time.sleep(random.uniform(0.05,0.6))
+            bench.clear()
+            start = time.perf_counter()
+            bench.pigpiod.set_level(DOOR_GPIO[pin],level)
+            latencies.append(bench.wait_message(DOOR_TOPIC,state.encode()) - start)
+    finally:
+        stop(process)
+    return summary(latencies)
+
+
+def actuate_latency(bench,iterations) -> dict:
+    process = start_door(bench,'edge')
+    latencies = []
+    try:
+        for index in range(iterations):
+            bench.clear()
+            start = time.perf_counter()
+            bench.broker.publish(DOOR_TOPIC + '/actuate',b'')
+            latencies.append(bench.wait_write(DOOR_GPIO['act'],1) - start)
+            # The relay is held for a second and ignores actuations meanwhile.
+            bench.wait_write(DOOR_GPIO['act'],0)
+            time.sleep(0.1)
+    finally:
+        stop(process)
+    return summary(latencies)
+
+
+def sensor_cpu(bench,sensors,duration) -> dict:
+    bench.clear()
+    process = bench.garage(bench.config(sensors))
+    try:
+        # Let the imports and connection settle before measuring.
+        time.sleep(2)
+        start = cpu_seconds(process.pid)
+        published = len(bench.messages())
+        time.sleep(duration)
+        cpu = cpu_seconds(process.pid) - start
+        published = len(bench.messages()) - published
+    finally:
+        stop(process)
+    return {'cpu_percent': round(cpu / duration * 100,3), 'publishes': published}
+
+
+def publish_throughput(bench,qos,count) -> dict:
+    config = bench.config([])
+    received = bench.broker.received
+    output = subprocess.run(
+        [sys.executable,'-m','bench.publisher','--config',json.dumps(config),'--count',str(count),'--qos',str(qos)],
+        cwd=ROOT,
+        env=dict(os.environ,PYTHONPATH=ROOT),
+        stdout=subprocess.PIPE,
+        check=True).stdout
+    result = json.loads(output)
+    result['received'] = bench.broker.received - received
+    del result['metrics']
+    return result
+
+
+def revision() -> str:
+    try:
+        return subprocess.run(['git','describe','--always','--dirty'],cwd=ROOT,stdout=subprocess.PIPE,stderr=subprocess.DEVNULL,check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline,results,path=''):
+    for key, value in results.items():
+        name = f'{path}.{key}' if path else key
+        if isinstance(value,dict):
+            compare(baseline.get(key,{}),value,name)
+        elif isinstance(value,(int,float)) and isinstance(baseline.get(key),(int,float)) and baseline[key]:
+            print(f'{name:50} {baseline[key]:>12} {value:>12} {(value - baseline[key]) / baseline[key] * 100:+8.1f}%')
+
+
+BENCHMARKS = ['door', 'actuate', 'cpu', 'publish']
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m bench')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, default=BENCHMARKS, help='Benchmarks to run')
+    parser.add_argument('--iterations', type=int, default=20, help='Door transitions per mode')
+    parser.add_argument('--actuations', type=int, default=5)
+    parser.add_argument('--duration', type=float, default=10, help='Seconds each sensor is measured for CPU')
+    parser.add_argument('--count', type=int, default=10000, help='Messages per publish throughput run')
+    parser.add_argument('--output', help='Write the results to this file instead of stdout')
+    parser.add_argument('--compare', help='Results of a previous run to compare against')
+    args = parser.parse_args()
+
+    bench = Bench()
+    results = {}
+    try:
+        if 'door' in args.only:
+            results['door_latency'] = {mode: door_latency(bench,mode,args.iterations) for mode in ['poll','edge','bank']}
+
+        if 'actuate' in args.only:
+            results['actuate_latency'] = actuate_latency(bench,args.actuations)
+
+        if 'cpu' in args.only:
+            bench.pigpiod.add_i2c_device(PRESSURE_I2C['bus'],PRESSURE_I2C['addr'],pressure_device)
+            results['cpu'] = {
+                'idle': sensor_cpu(bench,[],args.duration),
+                'door_poll': sensor_cpu(bench,[door_sensor('poll')],args.duration),
+                'door_edge': sensor_cpu(bench,[door_sensor('edge')],args.duration),
+                'door_bank': sensor_cpu(bench,[door_sensor('bank')],args.duration),
+                'sm9514': sensor_cpu(bench,[pressure_sensor()],args.duration),
+                'sm9514_oversample': sensor_cpu(bench,[pressure_sensor(50)],args.duration),
+                'sm9514_frames': sensor_cpu(bench,[pressure_sensor(50,3)],args.duration)
+            }
+
+        if 'publish' in args.only:
+            results['publish'] = {f'qos{qos}': publish_throughput(bench,qos,args.count) for qos in [0,1]}
+    finally:
+        bench.close()
+
+    report = {
+        'revision': revision(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ',time.gmtime()),
+        'results': results
+    }
+
+    if args.output:
+        with open(args.output,'w') as f:
+            json.dump(report,f,indent=2)
+    else:
+        print(json.dumps(report,indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f)['results'],results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+from threading import Thread, Lock
+import socket
+import struct
+
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def topic_matches(pattern,topic) -> bool:
+    pattern = pattern.split('/')
+    topic = topic.split('/')
+    for index, level in enumerate(pattern):
+        if level == '#':
+            return True
+        if index >= len(topic):
+            return False
+        if level != '+' and level != topic[index]:
+            return False
+    return len(pattern) == len(topic)
+
+
+def encode_length(length) -> bytes:
+    data = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        data.append(byte)
+        if not length:
+            return bytes(data)
+
+
+def encode_string(value) -> bytes:
+    value = value.encode() if isinstance(value,str) else value
+    return struct.pack('!H',len(value)) + value
+
+
+def packet(kind,flags,body) -> bytes:
+    return bytes([(kind << 4) | flags]) + encode_length(len(body)) + body
+
+
+class Session():
+
+    def __init__(self,sock):
+        self.sock = sock
+        self.lock = Lock()
+        self.client_id = None
+        self.subscriptions = {}
+        self.will = None
+
+
+    def send(self,data):
+        with self.lock:
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                pass
+
+
+# A minimal MQTT 3.1.1 broker. Subscriptions are served at qos 0, which is
+# all the benchmark needs, while publishes of any qos are acknowledged the
+# way a real broker would.
+class FakeBroker(Thread):
+
+    def __init__(self,host='127.0.0.1',port=0):
+        self.__server = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        self.__server.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        self.__server.bind((host,port))
+        self.__server.listen(8)
+        self.host, self.port = self.__server.getsockname()
+
+        self.__lock = Lock()
+        self.__sessions = []
+        self.__retained = {}
+        self.__listeners = []
+        self.received = 0
+
+        super().__init__(target=self.__serve,daemon=True)
+
+
+    # fn(topic, payload, qos, retain) is called for every publish received.
+    def on_publish(self,fn):
+        self.__listeners.append(fn)
+
+
+    def retained(self) -> dict:
+        with self.__lock:
+            return dict(self.__retained)
+
+
+    def publish(self,topic,payload,retain=False):
+        self.__route(topic,payload,retain)
+
+
+    def __route(self,topic,payload,retain):
+        with self.__lock:
+            if retain:
+                if payload:
+                    self.__retained[topic] = payload
+                else:
+                    self.__retained.pop(topic,None)
+            sessions = list(self.__sessions)
+
+        data = packet(PUBLISH,0,encode_string(topic) + payload)
+        for session in sessions:
+            if any(topic_matches(pattern,topic) for pattern in list(session.subscriptions)):
+                session.send(data)
+
+
+    def __recv(self,sock,count) -> bytes:
+        data = b''
+        while len(data) < count:
+            chunk = sock.recv(count - len(data))
+            if not chunk:
+                raise ConnectionError('closed')
+            data += chunk
+        return data
+
+
+    def __read_packet(self,sock) -> tuple:
+        header = self.__recv(sock,1)[0]
+        length = 0
+        shift = 0
+        while True:
+            byte = self.__recv(sock,1)[0]
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return (header >> 4,header & 0x0F,self.__recv(sock,length) if length else b'')
+
+
+    def __connect(self,session,body):
+        index = 2 + struct.unpack('!H',body[0:2])[0]
+        flags = body[index + 1]
+        index += 4
+
+        length = struct.unpack('!H',body[index:index + 2])[0]
+        session.client_id = body[index + 2:index + 2 + length].decode()
+        index += 2 + length
+
+        if flags & 0x04:
+            length = struct.unpack('!H',body[index:index + 2])[0]
+            topic = body[index + 2:index + 2 + length].decode()
+            index += 2 + length
+            length = struct.unpack('!H',body[index:index + 2])[0]
+            payload = body[index + 2:index + 2 + length]
+            session.will = (topic,payload,bool(flags & 0x20))
+
+        session.send(packet(CONNACK,0,b'\x00\x00'))
+
+
+    def __publish(self,session,flags,body):
+        qos = (flags >> 1) & 0x03
+        retain = bool(flags & 0x01)
+        length = struct.unpack('!H',body[0:2])[0]
+        topic = body[2:2 + length].decode()
+        index = 2 + length
+        if qos:
+            mid = body[index:index + 2]
+            index += 2
+        payload = body[index:]
+
+        self.received += 1
+        for fn in self.__listeners:
+            fn(topic,payload,qos,retain)
+
+        if qos == 1:
+            session.send(packet(PUBACK,0,mid))
+        elif qos == 2:
+            session.send(packet(PUBREC,0,mid))
+
+        self.__route(topic,payload,retain)
+
+
+    def __subscribe(self,session,body):
+        mid = body[0:2]
+        index = 2
+        granted = bytearray()
+        patterns = []
+        while index < len(body):
+            length = struct.unpack('!H',body[index:index + 2])[0]
+            pattern = body[index + 2:index + 2 + length].decode()
+            index += 3 + length
+            session.subscriptions[pattern] = 0
+            patterns.append(pattern)
+            granted.append(0)
+        session.send(packet(SUBACK,0,mid + bytes(granted)))
+
+        for topic, payload in self.retained().items():
+            if any(topic_matches(pattern,topic) for pattern in patterns):
+                session.send(packet(PUBLISH,1,encode_string(topic) + payload))
+
+
+    def __unsubscribe(self,session,body):
+        mid = body[0:2]
+        index = 2
+        while index < len(body):
+            length = struct.unpack('!H',body[index:index + 2])[0]
+            session.subscriptions.pop(body[index + 2:index + 2 + length].decode(),None)
+            index += 2 + length
+        session.send(packet(UNSUBACK,0,mid))
+
+
+    def __connection(self,sock):
+        sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        session = Session(sock)
+        with self.__lock:
+            self.__sessions.append(session)
+
+        try:
+            while True:
+                kind, flags, body = self.__read_packet(sock)
+                if kind == CONNECT:
+                    self.__connect(session,body)
+                elif kind == PUBLISH:
+                    self.__publish(session,flags,body)
+                elif kind == PUBREL:
+                    session.send(packet(PUBCOMP,0,body[0:2]))
+                elif kind == SUBSCRIBE:
+                    self.__subscribe(session,body)
+                elif kind == UNSUBSCRIBE:
+                    self.__unsubscribe(session,body)
+                elif kind == PINGREQ:
+                    session.send(packet(PINGRESP,0,b''))
+                elif kind == DISCONNECT:
+                    session.will = None
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            with self.__lock:
+                self.__sessions.remove(session)
+            sock.close()
+
+            if session.will is not None:
+                self.__route(*session.will)
+
+
+    def __serve(self):
+        while True:
+            try:
+                sock, _ = self.__server.accept()
+            except OSError:
+                return
+            Thread(target=self.__connection,args=(sock,),daemon=True).start()
+
+
+    # Drops every client connection, as a broker restart would.
+    def drop_clients(self):
+        with self.__lock:
+            sessions = list(self.__sessions)
+        for session in sessions:
+            try:
+                session.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+    def close(self):
+        self.__server.close()
@@ -0,0 +1,273 @@
+from threading import Thread, Lock
+import socket
+import struct
+import time
+
+
+PI_CMD_MODES = 0
+PI_CMD_MODEG = 1
+PI_CMD_READ = 3
+PI_CMD_WRITE = 4
+PI_CMD_BR1 = 10
+PI_CMD_TICK = 16
+PI_CMD_NB = 19
+PI_CMD_NC = 21
+PI_CMD_PROC = 38
+PI_CMD_PROCD = 39
+PI_CMD_PROCR = 40
+PI_CMD_PROCS = 41
+PI_CMD_PROCP = 45
+PI_CMD_I2CO = 54
+PI_CMD_I2CC = 55
+PI_CMD_I2CRD = 56
+PI_CMD_I2CZ = 92
+PI_CMD_NOIB = 99
+
+PI_BAD_HANDLE = -25
+PI_BAD_SCRIPT_ID = -48
+
+PI_SCRIPT_HALTED = 1
+PI_SCRIPT_RUNNING = 2
+
+I2C_END = 0
+I2C_ESC = 1
+I2C_ADDR = 4
+I2C_READ = 6
+I2C_WRITE = 7
+
+COMMAND = struct.Struct('<IIII')
+REPORT = struct.Struct('<HHII')
+
+
+# A pigpiod stand-in speaking the socket protocol of the pigpio module, with
+# GPIO levels and I2C devices scripted by the benchmark.
+class FakePigpiod(Thread):
+
+    def __init__(self,host='127.0.0.1',port=0):
+        self.__server = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        self.__server.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        self.__server.bind((host,port))
+        self.__server.listen(8)
+        self.host, self.port = self.__server.getsockname()
+
+        self.__lock = Lock()
+        self.__start = time.monotonic()
+        self.__levels = 0
+        self.__modes = {}
+        self.__handles = {}
+        self.__devices = {}
+        self.__notify = {}
+        self.__write_listeners = []
+        self.__scripts = {}
+        self.__next_handle = 0
+        self.commands = 0
+
+        super().__init__(target=self.__serve,daemon=True)
+
+
+    def tick(self) -> int:
+        return int((time.monotonic() - self.__start) * 1000000) & 0xFFFFFFFF
+
+
+    def set_level(self,gpio,level):
+        with self.__lock:
+            if level:
+                self.__levels |= 1 << gpio
+            else:
+                self.__levels &= ~(1 << gpio)
+            levels = self.__levels
+            notify = list(self.__notify.values())
+
+        report = REPORT.pack(0,0,self.tick(),levels)
+        for entry in notify:
+            if entry['bits'] & (1 << gpio):
+                with entry['lock']:
+                    try:
+                        entry['socket'].sendall(report)
+                    except OSError:
+                        pass
+
+
+    def level(self,gpio) -> int:
+        return (self.__levels >> gpio) & 1
+
+
+    # fn(count) returns the bytes a read of count bytes from the device sees.
+    def add_i2c_device(self,bus,addr,fn):
+        self.__devices[(bus,addr)] = fn
+
+
+    # fn(gpio, level) is called for every write command.
+    def on_write(self,fn):
+        self.__write_listeners.append(fn)
+
+
+    def __recv(self,sock,count) -> bytes:
+        data = b''
+        while len(data) < count:
+            chunk = sock.recv(count - len(data))
+            if not chunk:
+                raise ConnectionError('closed')
+            data += chunk
+        return data
+
+
+    def __i2c_read(self,handle,count) -> bytes:
+        bus, addr = self.__handles[handle]
+        if not (bus,addr) in self.__devices:
+            return b''
+        return bytes(self.__devices[(bus,addr)](count))[:count]
+
+
+    def __i2c_zip(self,handle,ext) -> bytes:
+        bus, addr = self.__handles[handle]
+        data = b''
+        index = 0
+        while index < len(ext) and ext[index] != I2C_END:
+            cmd = ext[index]
+            if cmd == I2C_ADDR:
+                addr = ext[index + 1]
+                index += 2
+            elif cmd == I2C_READ:
+                count = ext[index + 1]
+                if (bus,addr) in self.__devices:
+                    data += bytes(self.__devices[(bus,addr)](count))[:count]
+                index += 2
+            elif cmd == I2C_WRITE:
+                index += 2 + ext[index + 1]
+            else:
+                index += 1
+        return data
+
+
+    # Runs the subset of the script language the actuator pulse uses,
+    # "w gpio level" and "mils ms".
+    def __run_script(self,script_id):
+        script = self.__scripts[script_id]
+        words = script['text'].split()
+        index = 0
+        while index < len(words):
+            if words[index] == 'w':
+                gpio, level = int(words[index + 1]), int(words[index + 2])
+                for fn in self.__write_listeners:
+                    fn(gpio,level)
+                self.set_level(gpio,level)
+                index += 3
+            elif words[index] == 'mils':
+                time.sleep(int(words[index + 1]) / 1000)
+                index += 2
+            else:
+                index += 1
+        script['status'] = PI_SCRIPT_HALTED
+
+
+    def __command(self,sock,cmd,p1,p2,ext) -> tuple:
+        self.commands += 1
+
+        if cmd == PI_CMD_MODES:
+            self.__modes[p1] = p2
+        elif cmd == PI_CMD_MODEG:
+            return (self.__modes.get(p1,0),b'')
+        elif cmd == PI_CMD_READ:
+            return (self.level(p1),b'')
+        elif cmd == PI_CMD_WRITE:
+            for fn in self.__write_listeners:
+                fn(p1,p2)
+            self.set_level(p1,p2)
+        elif cmd == PI_CMD_BR1:
+            return (self.__levels,b'')
+        elif cmd == PI_CMD_TICK:
+            return (self.tick(),b'')
+        elif cmd == PI_CMD_NB:
+            with self.__lock:
+                if p1 in self.__notify:
+                    self.__notify[p1]['bits'] = p2
+        elif cmd == PI_CMD_NOIB:
+            with self.__lock:
+                handle = len(self.__notify)
+                self.__notify[handle] = {'socket': sock, 'lock': Lock(), 'bits': 0}
+            return (handle,b'')
+        elif cmd == PI_CMD_NC:
+            with self.__lock:
+                self.__notify.pop(p1,None)
+        elif cmd == PI_CMD_PROC:
+            script_id = self.__next_handle
+            self.__next_handle += 1
+            self.__scripts[script_id] = {'text': ext.decode(), 'status': PI_SCRIPT_HALTED}
+            return (script_id,b'')
+        elif cmd == PI_CMD_PROCD:
+            if self.__scripts.pop(p1,None) is None:
+                return (PI_BAD_SCRIPT_ID,b'')
+        elif cmd == PI_CMD_PROCR:
+            if not p1 in self.__scripts:
+                return (PI_BAD_SCRIPT_ID,b'')
+            self.__scripts[p1]['status'] = PI_SCRIPT_RUNNING
+            Thread(target=self.__run_script,args=(p1,),daemon=True).start()
+        elif cmd == PI_CMD_PROCP:
+            if not p1 in self.__scripts:
+                return (PI_BAD_SCRIPT_ID,b'')
+            return (44,struct.pack('<11i',self.__scripts[p1]['status'],*([0] * 10)))
+        elif cmd == PI_CMD_I2CO:
+            handle = self.__next_handle
+            self.__next_handle += 1
+            self.__handles[handle] = (p1,p2)
+            return (handle,b'')
+        elif cmd == PI_CMD_I2CC:
+            if self.__handles.pop(p1,None) is None:
+                return (PI_BAD_HANDLE,b'')
+        elif cmd == PI_CMD_I2CRD:
+            if not p1 in self.__handles:
+                return (PI_BAD_HANDLE,b'')
+            data = self.__i2c_read(p1,p2)
+            return (len(data),data)
+        elif cmd == PI_CMD_I2CZ:
+            if not p1 in self.__handles:
+                return (PI_BAD_HANDLE,b'')
+            data = self.__i2c_zip(p1,ext)
+            return (len(data),data)
+
+        return (0,b'')
+
+
+    def __connection(self,sock):
+        sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        lock = Lock()
+        try:
+            while True:
+                cmd, p1, p2, p3 = COMMAND.unpack(self.__recv(sock,COMMAND.size))
+                ext = self.__recv(sock,p3) if p3 else b''
+                res, data = self.__command(sock,cmd,p1,p2,ext)
+                with self.__notify_lock_for(sock,lock):
+                    sock.sendall(COMMAND.pack(cmd,p1,p2,res & 0xFFFFFFFF) + data)
+                if cmd == PI_CMD_NC:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            with self.__lock:
+                for handle, entry in list(self.__notify.items()):
+                    if entry['socket'] is sock:
+                        del self.__notify[handle]
+            sock.close()
+
+
+    # Replies on a notification socket must not interleave with reports.
+    def __notify_lock_for(self,sock,default) -> Lock:
+        with self.__lock:
+            for entry in self.__notify.values():
+                if entry['socket'] is sock:
+                    return entry['lock']
+        return default
+
+
+    def __serve(self):
+        while True:
+            try:
+                sock, _ = self.__server.accept()
+            except OSError:
+                return
+            Thread(target=self.__connection,args=(sock,),daemon=True).start()
+
+
+    def close(self):
+        self.__server.close()
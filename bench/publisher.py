@@ -0,0 +1,55 @@
+from garage.mqtt import Mqtt
+from garage.metrics import metrics
+
+import argparse
+import json
+import resource
+import time
+
+
+# Publishes a burst of messages through Mqtt and reports how fast they were
+# handed to paho, run as its own process so the cost is not mixed with the
+# stand-ins serving it.
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', required=True)
+    parser.add_argument('--count', type=int, default=10000)
+    parser.add_argument('--qos', type=int, default=0)
+    parser.add_argument('--size', type=int, default=16)
+    args = parser.parse_args()
+
+    client = Mqtt(json.loads(args.config))
+    client.connect()
+
+    deadline = time.monotonic() + 10
+    while not client.is_connected():
+        if time.monotonic() > deadline:
+            raise SystemExit('broker did not accept the connection')
+        time.sleep(0.01)
+
+    payload = b'x' * args.size
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    for index in range(args.count):
+        client.publish('bench/publish',payload,qos=args.qos)
+    elapsed = time.perf_counter() - start
+    end = resource.getrusage(resource.RUSAGE_SELF)
+
+    # Leave time for paho to drain its queue before disconnecting.
+    deadline = time.monotonic() + 60
+    while (client._out_packet or client._out_messages) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    client.disconnect()
+
+    cpu = (end.ru_utime - usage.ru_utime) + (end.ru_stime - usage.ru_stime)
+    print(json.dumps({
+        'count': args.count,
+        'seconds': elapsed,
+        'per_second': args.count / elapsed,
+        'cpu_us_per_message': cpu * 1000000 / args.count,
+        'metrics': metrics.snapshot()
+    }))
+
+
+if __name__ == '__main__':
+    main()
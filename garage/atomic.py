@@ -0,0 +1,10 @@
+import os
+
+
+# Writes data, str or bytes, to a temporary file renamed over path, so a
+# reader or a crash never sees a partial file. Raises OSError on failure.
+def atomic_write(path,data):
+    mode = 'wb' if isinstance(data,(bytes,bytearray)) else 'w'
+    with open(path + '.tmp',mode) as f:
+        f.write(data)
+    os.replace(path + '.tmp',path)
@@ -0,0 +1,90 @@
+from .logger import logger
+from .clock import clock
+
+from threading import Thread, Event, Lock
+import json
+import struct
+
+
+BATCH_VERSION = 1
+
+# version, sample count
+BATCH_HEADER_FORMAT = '<BH'
+BATCH_HEADER = struct.Struct(BATCH_HEADER_FORMAT)
+
+# wall clock time, value
+BATCH_SAMPLE_FORMAT = '<df'
+BATCH_SAMPLE = struct.Struct(BATCH_SAMPLE_FORMAT)
+
+# Keeps a batch within a single journal record.
+BATCH_MAX_SAMPLES = 4096
+
+
+class Batcher(Thread):
+
+    def __init__(self,interval,publish):
+        self.__interval = interval
+        self.__publish = publish
+
+        self.__stop = Event()
+
+        self.__samples_lock = Lock()
+        self.__samples = {}
+        self.__schemas = set()
+
+        super().__init__(target=self.__run)
+
+
+    def add(self,topic,value,timestamp=None):
+        if timestamp is None:
+            timestamp = clock.time()
+
+        with self.__samples_lock:
+            if not topic in self.__samples:
+                self.__samples[topic] = bytearray()
+            self.__samples[topic] += BATCH_SAMPLE.pack(timestamp,value)
+            full = len(self.__samples[topic]) >= BATCH_MAX_SAMPLES * BATCH_SAMPLE.size
+
+        if full:
+            self.flush()
+
+
+    def __publish_schema(self,topic):
+        schema = {
+            'version': BATCH_VERSION,
+            'header': BATCH_HEADER_FORMAT,
+            'header_fields': ['version','count'],
+            'sample': BATCH_SAMPLE_FORMAT,
+            'sample_fields': ['time','value']
+        }
+        self.__publish(topic + '/batch/schema',json.dumps(schema),qos=1,retain=True)
+        self.__schemas.add(topic)
+
+
+    def flush(self):
+        with self.__samples_lock:
+            samples = self.__samples
+            self.__samples = {}
+
+        for topic, data in samples.items():
+            if not topic in self.__schemas:
+                self.__publish_schema(topic)
+
+            count = len(data) // BATCH_SAMPLE.size
+            logger.debug('%s: flushing %s samples',topic,count)
+            self.__publish(topic + '/batch',BATCH_HEADER.pack(BATCH_VERSION,count) + data)
+
+
+    def __run(self):
+        logger.info(f'batcher started with interval {self.__interval}')
+
+        while not clock.wait(self.__stop,self.__interval):
+            self.flush()
+
+        self.flush()
+
+
+    def stop(self):
+        self.__stop.set()
+        if self.is_alive():
+            self.join()
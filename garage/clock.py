@@ -0,0 +1,61 @@
+from threading import Lock
+import time
+
+
+# Time as seen by the sensors. It runs at real time unless a replay speeds it
+# up, in which case every duration is shortened by the scale.
+class Clock():
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__scale = 1.0
+        self.__real = time.monotonic()
+        self.__virtual = self.__real
+        self.__wall = time.time()
+
+
+    def scale(self) -> float:
+        return self.__scale
+
+
+    def set_scale(self,scale):
+        if scale <= 0:
+            raise ValueError('clock scale must be positive')
+
+        with self.__lock:
+            virtual = self.monotonic()
+            wall = self.time()
+            self.__real = time.monotonic()
+            self.__virtual = virtual
+            self.__wall = wall
+            self.__scale = float(scale)
+
+
+    def monotonic(self) -> float:
+        if self.__scale == 1.0 and self.__virtual == self.__real:
+            return time.monotonic()
+        return self.__virtual + (time.monotonic() - self.__real) * self.__scale
+
+
+    def time(self) -> float:
+        if self.__scale == 1.0 and self.__virtual == self.__real:
+            return time.time()
+        return self.__wall + (time.monotonic() - self.__real) * self.__scale
+
+
+    # Converts a duration in clock seconds into real seconds.
+    def real(self,seconds) -> float:
+        if seconds is None:
+            return None
+        return seconds / self.__scale
+
+
+    def sleep(self,seconds):
+        time.sleep(self.real(seconds))
+
+
+    def wait(self,event,timeout) -> bool:
+        return event.wait(self.real(timeout))
+
+
+clock = Clock()
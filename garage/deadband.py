@@ -0,0 +1,61 @@
+from .clock import clock
+
+
+class Deadband():
+
+    def __init__(self,config):
+        self.__parse_config(config)
+
+        self.__value = None
+        self.__time = 0
+
+
+    def __parse_config(self,config):
+        self.__abs = None
+        self.__rel = None
+        self.__heartbeat = None
+
+        if config is None:
+            return
+
+        if type(config) is not dict:
+            raise TypeError('"deadband" is not of type dict')
+
+        if 'abs' in config:
+            self.__abs = config['abs']
+
+        if 'rel' in config:
+            self.__rel = config['rel']
+
+        if 'heartbeat' in config:
+            self.__heartbeat = config['heartbeat']
+
+
+    def __outside(self,value) -> bool:
+        if self.__abs is None and self.__rel is None:
+            return True
+
+        delta = abs(value - self.__value)
+
+        if self.__abs is not None and delta > self.__abs:
+            return True
+
+        if self.__rel is not None and delta > abs(self.__value) * self.__rel:
+            return True
+
+        return False
+
+
+    # Returns True when the value should be published, which is when it has
+    # moved past the deadband since the last publish or the heartbeat expired.
+    def check(self,value) -> bool:
+        now = clock.monotonic()
+
+        if self.__value is not None and not self.__outside(value):
+            if self.__heartbeat is None or now - self.__time < self.__heartbeat:
+                return False
+
+        self.__value = value
+        self.__time = now
+
+        return True
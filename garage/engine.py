@@ -0,0 +1,125 @@
+from .logger import logger
+from .clock import clock
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+import asyncio
+
+
+class EngineTask():
+
+    def __init__(self,loop,executor,sensor):
+        self.__loop = loop
+        self.__executor = executor
+        self.__sensor = sensor
+        self.__future = None
+
+
+    async def __run(self):
+        reason = None
+        try:
+            reason = await self.__run_sensor()
+        except Exception as ex:
+            logger.exception(f'Sensor {self.__sensor} failed')
+            reason = repr(ex)
+            raise
+        finally:
+            self.__sensor.notify_exit(None if self.__sensor.stopping() else reason)
+
+
+    async def __run_sensor(self) -> str:
+        wake = asyncio.Event()
+        self.__sensor.set_waker(lambda: self.__loop.call_soon_threadsafe(wake.set))
+
+        # Everything that may block on pigpiod or sysfs runs on the executor.
+        # A setup that fails part way is undone by the teardown too.
+        try:
+            if not await self.__loop.run_in_executor(self.__executor,self.__sensor.setup):
+                return 'setup failed'
+
+            while not self.__sensor.stopping():
+                wake.clear()
+                delay = await self.__loop.run_in_executor(self.__executor,self.__sensor.run_step)
+                if delay is None:
+                    break
+                try:
+                    await asyncio.wait_for(wake.wait(),clock.real(delay))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await self.__loop.run_in_executor(self.__executor,self.__sensor.teardown)
+
+        return 'ended'
+
+
+    def start(self):
+        self.__future = asyncio.run_coroutine_threadsafe(self.__run(),self.__loop)
+
+
+    def register_on_exit(self,fn):
+        self.__sensor.register_on_exit(fn)
+
+
+    def is_alive(self) -> bool:
+        return self.__future is not None and not self.__future.done()
+
+
+    def stop(self):
+        self.__sensor.stop()
+        if self.__future is not None:
+            try:
+                self.__future.result()
+            except Exception:
+                pass
+
+
+class Engine(Thread):
+    __instance = None
+
+
+    @staticmethod
+    def instance():
+        if Engine.__instance is None:
+            raise Exception('Instance has not been created.')
+
+        return Engine.__instance
+
+
+    def __init__(self, config):
+        if Engine.__instance is not None:
+            raise Exception('Singleton instance already created.')
+
+        self.__parse_config(config)
+
+        self.__loop = asyncio.new_event_loop()
+        self.__executor = ThreadPoolExecutor(max_workers=self.__workers,thread_name_prefix='engine')
+
+        super().__init__(target=self.__run)
+
+        Engine.__instance = self
+
+
+    def __parse_config(self, config):
+        self.__workers = 2
+
+        if config is not None and 'engine' in config:
+            if 'workers' in config['engine']:
+                self.__workers = config['engine']['workers']
+
+
+    def __run(self):
+        logger.info(f'engine started with {self.__workers} workers')
+
+        asyncio.set_event_loop(self.__loop)
+        self.__loop.run_forever()
+        self.__loop.close()
+
+
+    def task(self,sensor) -> EngineTask:
+        return EngineTask(self.__loop,self.__executor,sensor)
+
+
+    def stop(self):
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+        self.join()
+        self.__executor.shutdown()
@@ -1,21 +1,36 @@
 import argparse
+import heapq
 import json
 import os
+import queue
+import random
 import signal
 import sys
 import time
 import threading
 
 from .logger import logger, parse_logger_config
+from .startup import startup
+
+# The signal handlers post to the supervisor's queue. A Queue takes a lock the
+# handler may have interrupted, a SimpleQueue is reentrant. Python 3.6 only
+# has the former.
+try:
+    EventQueue = queue.SimpleQueue
+except AttributeError:
+    EventQueue = queue.Queue
 
 
 def __parse_command_line_arguments() -> dict:
+    global config_input
+
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', nargs=1, default='', help='Configuration json in string or file form')
     args = parser.parse_args()
 
     if args.config:
-        config = __parse_config(args.config[0])
+        config_input = args.config[0]
+        config = __parse_config(config_input)
         if config is None:
             print('--config could not be reconciled. See log for details.')
             parser.print_help()
@@ -52,50 +67,328 @@ def __parse_config(input) -> dict:
         return None
 
 
+# The --config argument, read again when the configuration is reloaded.
+config_input = None
+
 config = __parse_command_line_arguments()
 
+
+def reload_config() -> dict:
+    if config_input is None:
+        return None
+    return __parse_config(config_input)
+
 # Parse the logger configuration ahead of any other import
 # in case a module also modifies the logger
 parse_logger_config(config)
 
 
-from .mqtt import Mqtt
-from .gpio import Gpio
-from .sm9514 import SM9514
-from .garagedoor import GarageDoor
-from .w1therm import W1Therm
+with startup.phase('import core'):
+    from .mqtt import Mqtt, mqtt
+    from .gpio import Gpio
+    from .gpiobank import GpioBank
+    from .i2cbus import I2cBus
+    from .trace import Recorder
+    from .replay import Replay, ReplayGpio
+    from .metrics import metrics, MetricsExporter
+    from .plugins import sensor_class
 
 
 class Main():
     def __init__(self):
         self.__stop = threading.Event()
+        self.__engine = None
+        self.__exporter = None
+
+        self.__events = EventQueue()
+        self.__sensors = []
+        self.__parse_supervisor_config(config)
+
+
+    def __parse_supervisor_config(self,config):
+        self.__backoff = 1.0
+        self.__backoff_max = 300.0
+        self.__jitter = 0.2
+        self.__budget = 10
+        self.__window = 3600.0
+        self.__status_topic = None
+        self.__control_topic = None
+
+        if config is not None and 'supervisor' in config:
+            if 'backoff' in config['supervisor']:
+                self.__backoff = config['supervisor']['backoff']
+            if 'backoff_max' in config['supervisor']:
+                self.__backoff_max = config['supervisor']['backoff_max']
+            if 'jitter' in config['supervisor']:
+                self.__jitter = config['supervisor']['jitter']
+            if 'budget' in config['supervisor']:
+                self.__budget = config['supervisor']['budget']
+            if 'window' in config['supervisor']:
+                self.__window = config['supervisor']['window']
+            if 'topic' in config['supervisor']:
+                self.__status_topic = config['supervisor']['topic']
+            if 'control' in config['supervisor']:
+                self.__control_topic = config['supervisor']['control']
+
 
     def start(self):
-        Mqtt(config)
-        Gpio(config)
+        with startup.phase('mqtt'):
+            Mqtt(config)
+            Mqtt.instance().register_on_connect(self.__on_connect)
+
+        # A replay stands in for pigpiod and ends the run when the trace does.
+        with startup.phase('gpio'):
+            if 'replay' in config:
+                Replay(config,self.stop)
+                ReplayGpio(config)
+            else:
+                Gpio(config)
+
+            if 'record' in config:
+                Recorder(config).start(Gpio.instance())
+
+            GpioBank(config).start()
+            I2cBus(config)
+
+        if 'engine' in config:
+            with startup.phase('engine'):
+                # asyncio is slow to import and only needed by the engine.
+                from .engine import Engine
+                self.__engine = Engine(config)
+                self.__engine.start()
+
+        if 'metrics' in config:
+            self.__exporter = MetricsExporter(config,Mqtt.instance().publish)
+            self.__exporter.start()
+
+        with startup.phase('sensors'):
+            sensors = self.__parse_sensor_config(config)
+            for sensor in sensors:
+                sensor["instance"] = self.__create_sensor_instance(sensor["supervisor"]["type"],sensor)
+            self.__sensors = sensors
+            for sensor in sensors:
+                self.__start_sensor_instance(sensor)
 
-        sensors = self.__parse_sensor_config(config)
-        for sensor in sensors:
-            sensor["instance"].start()
+        with startup.phase('connect'):
+            Mqtt.instance().connect()
 
-        Mqtt.instance().connect()
+        startup.report()
 
-        while not self.__stop.wait(1):
-            # Check to ensure sensors stay alive.
-            for sensor in sensors:
-                if not sensor["instance"].is_alive():
-                    logger.warning(f'Sensor "{sensor}" has failed, recreating.')
-                    self.__recreate_sensor_instance(sensor)
+        if Replay.enabled():
+            Replay.instance().start()
 
-        for sensor in sensors:
-            sensor["instance"].stop()
+        self.__supervise()
+
+        for sensor in self.__sensors:
+            if sensor["instance"] is not None:
+                sensor["instance"].stop()
             del sensor["instance"]
 
+        if self.__engine is not None:
+            self.__engine.stop()
+
+        if self.__exporter is not None:
+            self.__exporter.stop()
+
+        GpioBank.instance().stop()
+        I2cBus.instance().close()
+
+        if Replay.enabled():
+            Replay.instance().stop()
+
+        if Recorder.active() is not None:
+            Recorder.active().stop()
+
         Mqtt.instance().disconnect()
 
 
     def stop(self):
         self.__stop.set()
+        self.__events.put(None)
+
+
+    # Reloads the configuration from --config on the supervisor thread.
+    def reload(self):
+        self.__events.put(('reload',))
+
+
+    def __on_connect(self,client,userdata,flags,rc):
+        if self.__control_topic is not None and rc == mqtt.client.CONNACK_ACCEPTED:
+            Mqtt.instance().subscribe(self.__control_topic,qos=1)
+            Mqtt.instance().message_callback_add(self.__control_topic,self.__on_control)
+
+
+    # A "reload" payload reloads --config.
+    def __on_control(self,client,userdata,message):
+        payload = message.payload.decode(errors='replace').strip()
+        if payload != 'reload':
+            logger.warning(f'Unknown control message "{payload}" on {message.topic}')
+            return
+
+        self.reload()
+
+
+    def status(self) -> list:
+        return [sensor["supervisor"].copy() for sensor in self.__sensors]
+
+
+    def __publish_status(self):
+        if self.__status_topic is not None:
+            Mqtt.instance().publish(self.__status_topic,json.dumps(self.status()),qos=1,retain=True,conflate=True)
+
+
+    def __supervise(self):
+        pending = []
+        sequence = 0
+
+        while not self.__stop.is_set():
+            timeout = None
+            if pending:
+                timeout = max(0,pending[0][0] - time.monotonic())
+
+            try:
+                event = self.__events.get(timeout=timeout)
+            except queue.Empty:
+                event = None
+
+            if event is not None and event[0] == 'reload':
+                self.__reload()
+                self.__publish_status()
+                continue
+
+            if event is not None:
+                sensor, instance, reason = event
+                # Ignore stops and instances that were already replaced.
+                if reason is None or self.__stop.is_set() or sensor["instance"] is not instance:
+                    continue
+                delay = self.__sensor_failed(sensor,reason)
+                if delay is not None:
+                    sequence += 1
+                    heapq.heappush(pending,(time.monotonic() + delay,sequence,sensor))
+                self.__publish_status()
+
+            while pending and pending[0][0] <= time.monotonic() and not self.__stop.is_set():
+                _, _, sensor = heapq.heappop(pending)
+                # Sensors removed by a reload are not restarted.
+                if not [item for item in self.__sensors if item is sensor]:
+                    continue
+                self.__recreate_sensor_instance(sensor)
+                self.__publish_status()
+
+
+    # Names the sensor in the logs by its type, its position in "sensors"
+    # and its topic, as several sensors of a type may be running.
+    def __sensor_name(self,supervisor) -> str:
+        name = f'"{supervisor["type"]}" #{supervisor["index"]}'
+        if supervisor["topic"] is not None:
+            name += f' for topic \'{supervisor["topic"]}\''
+        return name
+
+
+    # Returns the delay before restarting the sensor, or None if it has used
+    # its restart budget.
+    def __sensor_failed(self,sensor,reason) -> float:
+        supervisor = sensor["supervisor"]
+        now = time.monotonic()
+
+        supervisor["last_failure"] = reason
+        supervisor["last_failure_time"] = time.time()
+        metrics.counter('sensor_failures_total',sensor=supervisor["type"]).inc()
+
+        # A sensor that ran longer than the longest backoff starts over.
+        if now - supervisor["started"] > self.__backoff_max:
+            supervisor["consecutive"] = 0
+
+        failures = [t for t in sensor["failures"] if now - t < self.__window]
+        failures.append(now)
+        sensor["failures"] = failures
+
+        if len(failures) > self.__budget:
+            logger.error(f'Sensor {self.__sensor_name(supervisor)} failed ({reason}) {len(failures)} times in {self.__window} s, giving up.')
+            supervisor["state"] = 'failed'
+            return None
+
+        delay = min(self.__backoff_max,self.__backoff * (2 ** supervisor["consecutive"]))
+        delay *= 1 + random.uniform(-self.__jitter,self.__jitter)
+        supervisor["consecutive"] += 1
+        supervisor["state"] = 'backoff'
+
+        logger.warning(f'Sensor {self.__sensor_name(supervisor)} has failed ({reason}), recreating in {delay:.1f} s.')
+        return delay
+
+
+    # Stops and starts only the sensors whose configuration changed, leaving
+    # Mqtt, Gpio and the unchanged sensors running.
+    def __reload(self):
+        global config
+
+        new_config = reload_config()
+        if new_config is None:
+            logger.error('Configuration could not be reloaded, keeping the running configuration.')
+            return
+
+        try:
+            sensors = self.__parse_sensor_config(new_config)
+        except (ValueError, TypeError) as ex:
+            logger.error(f'Reloaded configuration is invalid ({ex}), keeping the running configuration.')
+            return
+
+        for key in ['mqtt','gpio','gpiobank','i2c','engine','metrics','logger','replay','record']:
+            if new_config.get(key) != config.get(key):
+                logger.warning(f'"{key}" changed, it takes effect on the next restart.')
+
+        kept = []
+        running = list(self.__sensors)
+        added = []
+        for sensor in sensors:
+            match = [item for item in running if item["config"] == sensor["config"]]
+            if match:
+                running = [item for item in running if item is not match[0]]
+                match[0]["supervisor"]["index"] = sensor["supervisor"]["index"]
+                kept.append(match[0])
+            else:
+                added.append(sensor)
+
+        # Create the new instances first so a bad sensor configuration leaves
+        # the running sensors alone.
+        try:
+            for sensor in added:
+                sensor["instance"] = self.__create_sensor_instance(sensor["supervisor"]["type"],sensor)
+        except (ValueError, TypeError) as ex:
+            logger.error(f'Reloaded sensor configuration is invalid ({ex}), keeping the running configuration.')
+            return
+
+        # The removed sensors release their pins and topics before the
+        # changed ones take them over.
+        for sensor in running:
+            instance = sensor["instance"]
+            sensor["instance"] = None
+            if instance is not None:
+                instance.stop()
+
+        control_topic = self.__control_topic
+        self.__parse_supervisor_config(new_config)
+        if self.__control_topic != control_topic:
+            if control_topic is not None:
+                Mqtt.instance().message_callback_remove(control_topic)
+                Mqtt.instance().unsubscribe(control_topic)
+            if Mqtt.instance().is_connected():
+                self.__on_connect(None,None,None,mqtt.client.CONNACK_ACCEPTED)
+        config = new_config
+        self.__sensors = kept + added
+        for sensor in added:
+            self.__start_sensor_instance(sensor)
+
+        logger.info(f'Configuration reloaded, {len(kept)} sensors kept, {len(running)} stopped, {len(added)} started.')
+
+
+    def __start_sensor_instance(self,item):
+        instance = item["instance"]
+        instance.register_on_exit(lambda reason: self.__events.put((item,instance,reason)))
+
+        item["supervisor"]["started"] = time.monotonic()
+        item["supervisor"]["state"] = 'running'
+        instance.start()
 
 
     def __parse_sensor_config(self,config) -> dict:
@@ -110,7 +403,7 @@ class Main():
         if type(config['sensors']) is not list:
             raise TypeError('"sensors" is not a list')
 
-        for item in config['sensors']:
+        for index, item in enumerate(config['sensors']):
             if len(item) != 1:
                 raise ValueError('Only 1 sensor must be defined in each "sensors" object')
 
@@ -123,27 +416,41 @@ class Main():
                 if type(value) is not dict:
                     raise TypeError(f'Invalid (not a dict) type found as a value for "{key}" in "sensors"')
 
-                instance = self.__create_sensor_instance(item)
-                
-                if instance is None:
+                if sensor_class(key) is None:
                     logger.warning(f'Unknown sensor type "{key}" found in "sensors"')
                 else:
                     _item = item.copy()
-                    _item["instance"] = instance
+                    _item["instance"] = None
+                    # Compared on reload to find the sensors that changed.
+                    _item["config"] = json.dumps(item,sort_keys=True)
+                    _item["failures"] = []
+                    _item["supervisor"] = {
+                        "type": key,
+                        "topic": value.get('topic'),
+                        "index": index,
+                        "state": 'created',
+                        "started": 0,
+                        "restarts": 0,
+                        "consecutive": 0,
+                        "last_failure": None,
+                        "last_failure_time": None
+                    }
                     _sensors.append(_item)
 
         return _sensors
 
 
-    def __create_sensor_instance(self,config) -> object:
+    def __create_sensor_instance(self,key,config) -> object:
         instance = None
 
-        if "sm9514" in config:
-            instance = SM9514(config)
-        elif "garagedoor" in config:
-            instance = GarageDoor(config)
-        elif "w1therm" in config:
-            instance = W1Therm(config)
+        # Only the modules of the configured sensor types are imported.
+        cls = sensor_class(key)
+        if cls is not None:
+            instance = cls(config)
+
+        # Run the sensor as a task on the shared engine instead of its own thread.
+        if instance is not None and self.__engine is not None:
+            instance = self.__engine.task(instance)
 
         return instance
 
@@ -152,12 +459,14 @@ class Main():
         del item["instance"]
         item["instance"] = None
 
-        instance = self.__create_sensor_instance(item)
+        instance = self.__create_sensor_instance(item["supervisor"]["type"],item)
         if instance is None:
-            logger.error(f'Could not recreate sensor {item}')
+            logger.error(f'Could not recreate sensor {self.__sensor_name(item["supervisor"])}')
+            item["supervisor"]["state"] = 'failed'
         else:
             item["instance"] = instance
-            instance.start()
+            item["supervisor"]["restarts"] += 1
+            self.__start_sensor_instance(item)
 
 
 def __signal_handler(signal, frame):
@@ -168,6 +477,11 @@ def __signal_handler(signal, frame):
         sys.exit(0)
 
 
+def __reload_handler(signal, frame):
+    logger.info(f"Caught signal {signal}, reloading the configuration")
+    gmain.reload()
+
+
 def main():
     global gmain
 
@@ -177,6 +491,8 @@ def main():
 
     gmain = Main()
 
+    signal.signal(signal.SIGHUP, __reload_handler)
+
     logger.info("Start.")
 
     gmain.start()
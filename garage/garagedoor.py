@@ -1,8 +1,13 @@
 from .logger import logger
 from .mqtt import Mqtt, mqtt
 from .gpio import Gpio, gpio
+from .gpiobank import GpioBank
+from .sensor import Sensor
+from .clock import clock
+from .travel import TravelModel
 
-from threading import Thread, Event, Timer
+from threading import Timer
+import json
 import time
 
 
@@ -17,16 +22,33 @@ DOOR_STATE_OPEN = 4
 DOOR_STATE_STOPPED = 5
 
 
-class GarageDoor(Thread):
+GARAGEDOOR_MODES = ['poll','edge','bank']
+
+# Seconds of travel after which a door is stopped until it has learned its
+# travel time, and the most it will ever wait.
+GARAGEDOOR_TRAVEL_MAX = 30.0
+
+
+class GarageDoor(Sensor):
 
     def __init__(self,config):
         self.__parse_config(config)
 
-        self.__stop = Event()
-
         self.__act_timer = None
+        self.__act_script = None
+        self.__act_callback = None
+        self.__pulse_end = 0
+        self.__ack = None
+        self.__new_door_state = DOOR_STATE_UNKNOWN
+
+        self.__travel = TravelModel(self.__travel_config,GARAGEDOOR_TRAVEL_MAX)
+        self.__direction = None
+        self.__position_time = 0
 
-        super().__init__(target=self.__run)
+        self.__callbacks = []
+        self.__levels = {}
+
+        super().__init__(self.__topic)
 
 
     def __parse_config(self,config):
@@ -35,6 +57,13 @@ class GarageDoor(Thread):
         self.__act = None
         self.__topic = None
         self.__rate = None
+        self.__mode = 'poll'
+        self.__glitch = 0
+        self.__noise = None
+        self.__pulse = 1000
+        self.__ack_timeout = 30.0
+        self.__travel_config = None
+        self.__position = 1.0
 
         if config is None or type(config) is not dict:
             raise TypeError('passed config is not of type dict')
@@ -46,11 +75,29 @@ class GarageDoor(Thread):
             raise ValueError('"topic" missing from the configuration')
         self.__topic = config['garagedoor']['topic']
         self.__act_topic = self.__topic + '/actuate'
+        self.__ack_topic = self.__act_topic + '/ack'
 
         if not 'rate' in config['garagedoor']:
             raise ValueError('"rate" missing from the configuration')
         self.__rate = config['garagedoor']['rate']
 
+        if 'pulse' in config['garagedoor']:
+            self.__pulse = config['garagedoor']['pulse']
+
+        if 'ack_timeout' in config['garagedoor']:
+            self.__ack_timeout = config['garagedoor']['ack_timeout']
+
+        if 'travel' in config['garagedoor']:
+            self.__travel_config = config['garagedoor']['travel']
+
+        if 'position' in config['garagedoor']:
+            self.__position = config['garagedoor']['position']
+
+        if 'mode' in config['garagedoor']:
+            if not config['garagedoor']['mode'] in GARAGEDOOR_MODES:
+                raise ValueError(f'"mode" must be one of {GARAGEDOOR_MODES}')
+            self.__mode = config['garagedoor']['mode']
+
         if not 'gpio' in config['garagedoor']:
             raise ValueError('"gpio" object missing from the configuration')
 
@@ -66,15 +113,31 @@ class GarageDoor(Thread):
             raise ValueError('"act" missing from the "gpio" object in the configuration')
         self.__act = config['garagedoor']['gpio']['act']
 
+        if 'glitch' in config['garagedoor']['gpio']:
+            self.__glitch = config['garagedoor']['gpio']['glitch']
+
+        if 'noise' in config['garagedoor']['gpio']:
+            if not 'steady' in config['garagedoor']['gpio']['noise']:
+                raise ValueError('"steady" missing from the "noise" object in the configuration')
+            if not 'active' in config['garagedoor']['gpio']['noise']:
+                raise ValueError('"active" missing from the "noise" object in the configuration')
+            self.__noise = (config['garagedoor']['gpio']['noise']['steady'],config['garagedoor']['gpio']['noise']['active'])
+
 
+    # The pulse is timed by a script stored in pigpiod so it is exact and
+    # costs a single call. Without one a timer turns the relay off.
     def __actuator_on(self):
-        Gpio.instance().write(self.__act,1)
-        self.__act_timer = Timer(1,self.__actuator_off)
+        if self.__act_script is not None:
+            Gpio.instance().channel('actuator').run_script(self.__act_script)
+            return
+
+        Gpio.instance().channel('actuator').write(self.__act,1)
+        self.__act_timer = Timer(clock.real(self.__pulse / 1000),self.__actuator_off)
         self.__act_timer.start()
 
 
     def __actuator_off(self):
-        Gpio.instance().write(self.__act,0)
+        Gpio.instance().channel('actuator').write(self.__act,0)
         self.__act_timer = None
 
 
@@ -84,19 +147,127 @@ class GarageDoor(Thread):
 
 
     def __on_message(self,client,userdata,message):
-        if self.__act_timer is not None:
+        now = clock.monotonic()
+        if now < self.__pulse_end:
             logger.debug('Received actuation while actuating')
             return
 
+        self.__pulse_end = now + self.__pulse / 1000
+        self.__ack = {
+            'received': now,
+            'state': self.__new_door_state,
+            'relay': None,
+            'tick': None,
+            'pulse': None,
+            'deadline': now + self.__ack_timeout
+        }
         self.__actuator_on()
+        self.wake()
+
+
+    # The relay's edges, reported by pigpiod like any other, time the pulse.
+    def __on_act_edge(self,pin,level,tick):
+        ack = self.__ack
+        if ack is None or level == gpio.TIMEOUT:
+            return
+
+        if level == 1:
+            ack['relay'] = clock.monotonic()
+            ack['tick'] = tick
+        elif ack['tick'] is not None:
+            ack['pulse'] = gpio.tickDiff(ack['tick'],tick) / 1000
+
+
+    def __act_start(self):
+        try:
+            self.__act_script = Gpio.instance().store_script(f'w {self.__act} 1 mils {self.__pulse} w {self.__act} 0'.encode())
+            # The daemon prepares the script in the background.
+            deadline = time.monotonic() + 1.0
+            while Gpio.instance().script_status(self.__act_script)[0] == gpio.PI_SCRIPT_INITING and time.monotonic() < deadline:
+                time.sleep(0.01)
+        except gpio.error as ex:
+            logger.warning(f'{self.__topic}: actuator script not stored ({ex}), timing the pulse locally')
+            self.__delete_act_script()
+
+        self.__act_callback = Gpio.instance().callback(self.__act,gpio.EITHER_EDGE,self.__on_act_edge)
+
+
+    def __act_stop(self):
+        if self.__act_callback is not None:
+            self.__act_callback.cancel()
+            self.__act_callback = None
+
+        self.__delete_act_script()
+
+
+    def __delete_act_script(self):
+        if self.__act_script is not None:
+            try:
+                Gpio.instance().delete_script(self.__act_script)
+            except gpio.error as ex:
+                logger.warning(f'{self.__topic}: actuator script not deleted ({ex})')
+            self.__act_script = None
+
+
+    # Acknowledges an actuation once the door moves or the timeout expires.
+    def __check_ack(self):
+        ack = self.__ack
+        now = clock.monotonic()
+        moved = self.__new_door_state != ack['state']
+        if not moved and now < ack['deadline']:
+            return
+
+        self.__ack = None
+        payload = {
+            'latency_ms': None if ack['relay'] is None else round((ack['relay'] - ack['received']) * 1000,1),
+            'pulse_ms': None if ack['pulse'] is None else round(ack['pulse'],1),
+            'from': door_state_str[ack['state']],
+            'to': door_state_str[self.__new_door_state] if moved else None,
+            'transition_ms': round((now - ack['received']) * 1000,1) if moved else None
+        }
+        logger.info('%s actuation %s',self.__topic,payload)
+        Mqtt.instance().publish(self.__ack_topic,json.dumps(payload),qos=1)
 
 
     def __on_connect(self,client, userdata, flags, rc):
         if rc == mqtt.client.CONNACK_ACCEPTED:
             self.__subscribe()
+            self.wake()
+
 
+    def __on_edge(self,pin,level,tick):
+        if level == gpio.TIMEOUT:
+            return
+
+        self.__levels[pin] = level
+        self.wake()
+
+
+    def __on_levels(self,levels):
+        self.__levels.update(levels)
+        self.wake()
+
+
+    def __edge_start(self):
+        for pin in [self.__top,self.__bot]:
+            if self.__glitch:
+                Gpio.instance().set_glitch_filter(pin,self.__glitch)
+            if self.__noise is not None:
+                Gpio.instance().set_noise_filter(pin,*self.__noise)
+            self.__callbacks.append(Gpio.instance().callback(pin,gpio.EITHER_EDGE,self.__on_edge))
+
+        # Seed the levels after the callbacks are in place so no edge is missed.
+        for pin in [self.__top,self.__bot]:
+            self.__levels[pin] = Gpio.instance().read(pin)
+
+
+    def __edge_stop(self):
+        for cb in self.__callbacks:
+            cb.cancel()
+        self.__callbacks = []
 
-    def __run(self):
+
+    def setup(self) -> bool:
         logger.info(f'garagedoor started for topic \'{self.__topic}\'')
 
         Gpio.instance().set_mode(self.__top,gpio.INPUT)
@@ -104,48 +275,129 @@ class GarageDoor(Thread):
         Gpio.instance().write(self.__act,0)
         Gpio.instance().set_mode(self.__act,gpio.OUTPUT)
 
+        self.__act_start()
+
         Mqtt.instance().register_on_connect(self.__on_connect)
         
         if Mqtt.instance().is_connected():
             self.__subscribe()
 
-        doorTime = 0
-        reportTime = time.monotonic()
-        doorState = DOOR_STATE_UNKNOWN
-        while not self.__stop.is_set():
+        if self.__mode == 'edge':
+            self.__edge_start()
+        elif self.__mode == 'bank':
+            GpioBank.instance().register([self.__top,self.__bot],self.__on_levels)
+
+        self.__door_time = 0
+        self.__report_time = clock.monotonic()
+        self.__door_state = DOOR_STATE_UNKNOWN
+        self.__new_door_state = DOOR_STATE_UNKNOWN
+
+        return True
 
+
+    def step(self) -> float:
+        if self.__mode == 'poll':
             gpioTop = Gpio.instance().read(self.__top)
             gpioBottom = Gpio.instance().read(self.__bot)
+        else:
+            gpioTop = self.__levels[self.__top]
+            gpioBottom = self.__levels[self.__bot]
 
-            if not gpioTop and gpioBottom:
-                newDoorState = DOOR_STATE_OPEN
-            
-            elif gpioTop and not gpioBottom:
-                newDoorState = DOOR_STATE_CLOSED
-            
-            elif gpioTop and gpioBottom:
-                if doorState == DOOR_STATE_OPEN:
-                    newDoorState = DOOR_STATE_CLOSING
-                    doorTime = time.monotonic()
-            
-                elif doorState == DOOR_STATE_CLOSED:
-                    newDoorState = DOOR_STATE_OPENING
-                    doorTime = time.monotonic()
-            
-                elif time.monotonic() - doorTime > 30.0:
-                    newDoorState = DOOR_STATE_STOPPED
-
-            if not Mqtt.instance().is_connected():
-                doorState = DOOR_STATE_UNKNOWN
-            elif doorState != newDoorState or time.monotonic() - reportTime > self.__rate:
-                reportTime = time.monotonic()
-                doorState = newDoorState
-                logger.info(f'{self.__topic} {door_state_str[doorState]}')
-                Mqtt.instance().publish(self.__topic,door_state_str[doorState],qos=1)
-
-            self.__stop.wait(0.5)
-
-
-    def stop(self):
-        self.__stop.set()
-        self.join()
+        if not gpioTop and gpioBottom:
+            self.__new_door_state = DOOR_STATE_OPEN
+            self.__travel_end('opening')
+        
+        elif gpioTop and not gpioBottom:
+            self.__new_door_state = DOOR_STATE_CLOSED
+            self.__travel_end('closing')
+        
+        elif gpioTop and gpioBottom:
+            if self.__door_state == DOOR_STATE_OPEN:
+                self.__new_door_state = DOOR_STATE_CLOSING
+                self.__door_time = clock.monotonic()
+                self.__direction = 'closing'
+        
+            elif self.__door_state == DOOR_STATE_CLOSED:
+                self.__new_door_state = DOOR_STATE_OPENING
+                self.__door_time = clock.monotonic()
+                self.__direction = 'opening'
+        
+            elif clock.monotonic() - self.__door_time > self.__travel.limit(self.__direction):
+                self.__new_door_state = DOOR_STATE_STOPPED
+
+        # Transitions while disconnected are only kept when they are journaled.
+        # The connect wakes the door, which then reports as its state differs.
+        if not Mqtt.instance().is_connected() and not Mqtt.instance().is_journaled():
+            self.__door_state = DOOR_STATE_UNKNOWN
+            self.__report_time = clock.monotonic()
+        elif self.__door_state != self.__new_door_state or clock.monotonic() - self.__report_time > self.__rate:
+            self.__report_time = clock.monotonic()
+            self.__door_state = self.__new_door_state
+            logger.info('%s %s',self.__topic,door_state_str[self.__door_state])
+            Mqtt.instance().publish(self.__topic,door_state_str[self.__door_state],qos=1,conflate=True)
+
+        if self.__ack is not None:
+            self.__check_ack()
+
+        if self.__new_door_state in [DOOR_STATE_OPENING,DOOR_STATE_CLOSING] and clock.monotonic() >= self.__position_time:
+            self.__publish_position()
+
+        if self.__mode == 'poll':
+            return 0.5
+
+        # Sleep until an edge, the next report or the stopped timeout.
+        timeout = self.__rate - (clock.monotonic() - self.__report_time)
+        if self.__new_door_state in [DOOR_STATE_OPENING,DOOR_STATE_CLOSING]:
+            timeout = min(timeout,self.__travel.limit(self.__direction) - (clock.monotonic() - self.__door_time))
+            if self.__position is not None and self.__travel.expected(self.__direction) is not None:
+                timeout = min(timeout,self.__position_time - clock.monotonic())
+        if self.__ack is not None:
+            timeout = min(timeout,self.__ack['deadline'] - clock.monotonic())
+        return max(timeout,0.1)
+
+
+    # Learns the travel time when the door reaches the end it was moving to.
+    # A door that was reported stopped but still got there was only slow.
+    def __travel_end(self,direction):
+        if self.__direction is None:
+            return
+
+        if self.__direction == direction:
+            self.__travel.observe(direction,clock.monotonic() - self.__door_time)
+            if self.__position is not None:
+                self.__send_position(100 if direction == 'opening' else 0,0)
+        self.__direction = None
+
+
+    def __send_position(self,percent,eta):
+        Mqtt.instance().publish(self.__topic + '/position',json.dumps({'percent': percent, 'eta': eta}),conflate=True)
+
+
+    # Estimates how far open the door is from the typical travel time.
+    def __publish_position(self):
+        if self.__position is None:
+            return
+
+        expected = self.__travel.expected(self.__direction)
+        if expected is None:
+            return
+
+        elapsed = clock.monotonic() - self.__door_time
+        done = min(0.99,elapsed / expected)
+        percent = round(100 * done if self.__direction == 'opening' else 100 * (1 - done))
+        self.__send_position(percent,round(max(0.0,expected - elapsed),1))
+        self.__position_time = clock.monotonic() + self.__position
+
+
+    def teardown(self):
+        if self.__mode == 'edge':
+            self.__edge_stop()
+        elif self.__mode == 'bank':
+            GpioBank.instance().unregister(self.__on_levels)
+
+        self.__act_stop()
+
+        Mqtt.instance().unregister_on_connect(self.__on_connect)
+        Mqtt.instance().message_callback_remove(self.__act_topic)
+        if Mqtt.instance().is_connected():
+            Mqtt.instance().unsubscribe(self.__act_topic)
@@ -1,7 +1,121 @@
+from .logger import logger
+from .metrics import metrics
+from .trace import Recorder
+
 import pigpio
 
+from threading import Lock
+import socket
+import time
+
+
+GPIO_MAIN_CHANNEL = 'main'
+
+
+# The lock pigpio holds around every command on a connection. Waiting for it
+# means another thread's command is in the way, which is what the wait
+# histogram shows.
+class GpioLock():
+
+    def __init__(self,channel):
+        self.__lock = Lock()
+        self.__wait = metrics.histogram('gpio_lock_wait_seconds',channel=channel)
+
+
+    def acquire(self,blocking=True,timeout=-1) -> bool:
+        if self.__lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+
+        start = time.perf_counter()
+        acquired = self.__lock.acquire(True,timeout)
+        self.__wait.observe(time.perf_counter() - start)
+        return acquired
+
+
+    def release(self):
+        self.__lock.release()
+
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.release()
+
+
+# A pigpiod command connection of its own, so the calls made on it never
+# queue behind those made on another. Callbacks are only available on the
+# Gpio instance, which also holds the notification connection.
+class GpioChannel(pigpio.pi):
+
+    def __init__(self, name, host, port):
+        self.name = name
+        self.connected = True
+        self._notify = None
+        self._host = host
+        self._port = port
+
+        self.sl = pigpio._socklock()
+        self.sl.l = GpioLock(name)
+        self.sl.s = socket.create_connection((host,port),None)
+        self.sl.s.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+
+
+    def __timed(self, call, fn, *args):
+        with metrics.timer('gpio_call_seconds',call=call,channel=self.name):
+            return fn(*args)
+
+
+    def read(self, gpio):
+        return self.__timed('read', super().read, gpio)
+
+
+    def write(self, gpio, level):
+        return self.__timed('write', super().write, gpio, level)
 
-class Gpio(pigpio.pi):
+
+    def read_bank_1(self):
+        return self.__timed('read_bank_1', super().read_bank_1)
+
+
+    def set_mode(self, gpio, mode):
+        return self.__timed('set_mode', super().set_mode, gpio, mode)
+
+
+    def run_script(self, script_id, params=None):
+        return self.__timed('run_script', super().run_script, script_id, params)
+
+
+    def i2c_open(self, i2c_bus, i2c_address, i2c_flags=0):
+        handle = self.__timed('i2c_open', super().i2c_open, i2c_bus, i2c_address, i2c_flags)
+        if Recorder.active() is not None:
+            Recorder.active().i2c_open(handle, i2c_bus, i2c_address)
+        return handle
+
+
+    def i2c_close(self, handle):
+        return self.__timed('i2c_close', super().i2c_close, handle)
+
+
+    def i2c_read_device(self, handle, count):
+        count, data = self.__timed('i2c_read_device', super().i2c_read_device, handle, count)
+        if Recorder.active() is not None:
+            Recorder.active().i2c_read(handle, count, data)
+        return (count, data)
+
+
+    def i2c_zip(self, handle, data):
+        count, result = self.__timed('i2c_zip', super().i2c_zip, handle, data)
+        if Recorder.active() is not None:
+            Recorder.active().i2c_zip(handle, data, count, result)
+        return (count, result)
+
+
+class Gpio(GpioChannel):
     __instance = None
 
 
@@ -9,7 +123,7 @@ class Gpio(pigpio.pi):
     def instance():
         if Gpio.__instance is None:
             raise Exception('Instance has not been created.')
-        
+
         return Gpio.__instance
 
 
@@ -19,19 +133,58 @@ class Gpio(pigpio.pi):
 
         self.__parse_config(config)
 
-        super().__init__(host=self.__host,port=self.__port)
+        self.name = GPIO_MAIN_CHANNEL
+        self._connect(self.__host,self.__port)
+
+        # Handles, scripts and callbacks belong to pigpiod rather than to a
+        # connection, so any channel can use those another one created.
+        self.__channels = {}
+        for name in self.__channel_names:
+            self.__channels[name] = self._open_channel(name,self.__host,self.__port)
 
         Gpio.__instance = self
 
 
+    # Connects to pigpiod. Backends that do not use one override this.
+    def _connect(self, host, port):
+        pigpio.pi.__init__(self,host=host,port=port)
+        self.sl.l = GpioLock(GPIO_MAIN_CHANNEL)
+
+
+    def _open_channel(self, name, host, port):
+        try:
+            return GpioChannel(name,host,port)
+        except OSError as ex:
+            logger.warning(f'gpio channel {name} not connected ({ex}), using the main connection')
+            return self
+
+
     def __parse_config(self, config):
         self.__host = 'localhost'
         self.__port = 8888
+        self.__channel_names = ['actuator','i2c']
         if config is not None and 'gpio' in config:
             if 'host' in config['gpio']:
                 self.__host = config['gpio']['host']
             if 'port' in config['gpio']:
                 self.__port = config['gpio']['port']
+            if 'channels' in config['gpio']:
+                if type(config['gpio']['channels']) is not list:
+                    raise TypeError('"channels" in the "gpio" object is not a list')
+                self.__channel_names = config['gpio']['channels']
+
+
+    # The connection for a subsystem, the main one unless it has its own.
+    def channel(self, name) -> GpioChannel:
+        return self.__channels.get(name,self)
+
+
+    def stop(self):
+        for channel in self.__channels.values():
+            if channel is not self:
+                channel.stop()
+        self.__channels = {}
+        super().stop()
 
 
-gpio = pigpio
\ No newline at end of file
+gpio = pigpio
@@ -0,0 +1,118 @@
+from .logger import logger
+from .gpio import Gpio, gpio
+from .clock import clock
+
+from threading import Thread, Event, Lock
+
+
+class GpioBank(Thread):
+    __instance = None
+
+
+    @staticmethod
+    def instance():
+        if GpioBank.__instance is None:
+            raise Exception('Instance has not been created.')
+
+        return GpioBank.__instance
+
+
+    def __init__(self, config):
+        if GpioBank.__instance is not None:
+            raise Exception('Singleton instance already created.')
+
+        self.__parse_config(config)
+
+        self.__stop = Event()
+        self.__wake = Event()
+
+        self.__listeners_lock = Lock()
+        self.__listeners = []
+
+        super().__init__(target=self.__run)
+
+        GpioBank.__instance = self
+
+
+    def __parse_config(self, config):
+        self.__rate = 0.5
+
+        if config is not None and 'gpiobank' in config:
+            if 'rate' in config['gpiobank']:
+                self.__rate = config['gpiobank']['rate']
+
+
+    def __decode(self, bits, pins) -> dict:
+        return {pin: (bits >> pin) & 1 for pin in pins}
+
+
+    def register(self, pins, fn):
+        mask = 0
+        for pin in pins:
+            mask |= 1 << pin
+
+        # Seed the listener so it has levels before the first tick.
+        bits = Gpio.instance().read_bank_1()
+        listener = {'pins': list(pins), 'mask': mask, 'last': bits & mask, 'fn': fn}
+
+        with self.__listeners_lock:
+            for _listener in self.__listeners:
+                if _listener['fn'] == fn:
+                    logger.warning(f'Function {fn} already registered')
+                    return
+            self.__listeners.append(listener)
+        self.__wake.set()
+
+        fn(self.__decode(bits,listener['pins']))
+
+
+    def unregister(self, fn):
+        with self.__listeners_lock:
+            for listener in self.__listeners:
+                if listener['fn'] == fn:
+                    self.__listeners.remove(listener)
+                    return
+
+        logger.warning(f'Function {fn} is not registered')
+
+
+    def __run(self):
+        logger.info(f'gpiobank started with rate {self.__rate}')
+
+        while not self.__stop.is_set():
+            # Idle until a door registers.
+            with self.__listeners_lock:
+                idle = not self.__listeners
+            if idle:
+                self.__wake.wait()
+                self.__wake.clear()
+                continue
+
+            if clock.wait(self.__stop,self.__rate):
+                break
+
+            with self.__listeners_lock:
+                listeners = list(self.__listeners)
+
+            # One round-trip for every configured input. A failed read or
+            # listener must not end the thread every bank mode door relies on.
+            try:
+                bits = Gpio.instance().read_bank_1()
+            except (gpio.error, OSError) as ex:
+                logger.warning(f'gpiobank read failed ({ex})')
+                continue
+
+            for listener in listeners:
+                if bits & listener['mask'] != listener['last']:
+                    listener['last'] = bits & listener['mask']
+                    try:
+                        listener['fn'](self.__decode(bits,listener['pins']))
+                    except Exception:
+                        logger.exception(f'gpiobank listener {listener["fn"]} failed')
+
+
+    def stop(self):
+        self.__stop.set()
+        self.__wake.set()
+        if self.is_alive():
+            self.join()
@@ -0,0 +1,234 @@
+from .logger import logger
+from .mqtt import Mqtt, mqtt
+from .metrics import metrics
+from .clock import clock
+from .batch import BATCH_VERSION, BATCH_HEADER, BATCH_SAMPLE, BATCH_MAX_SAMPLES
+from .atomic import atomic_write
+
+from array import array
+from threading import Lock
+import json
+import math
+import os
+import struct
+
+
+HISTORY_MAGIC = b'GHS1'
+
+# magic, capacity, sample count, next index
+HISTORY_HEADER = struct.Struct('<4sIII')
+
+# Wall clock seconds and value, 8 bytes a sample.
+HISTORY_TIME = 'I'
+HISTORY_VALUE = 'f'
+HISTORY_SAMPLE_SIZE = 8
+
+HISTORY_POINTS = 500
+
+
+# A fixed size ring of the values of a topic that answers requests on
+# <topic>/history/get. Its memory is the size times 8 bytes, allocated up
+# front. A history is shared by every sensor instance publishing the topic,
+# so it outlives restarts, and is optionally snapshotted to a file so it
+# outlives the process.
+class History():
+    __histories_lock = Lock()
+    __histories = {}
+
+
+    # A changed configuration replaces the history, starting it over unless
+    # its snapshot still fits.
+    @staticmethod
+    def get(topic,config):
+        with History.__histories_lock:
+            history = History.__histories.get(topic)
+            if history is None or history.config != config:
+                if history is not None:
+                    history.store()
+                history = History(topic,config)
+                History.__histories[topic] = history
+            return history
+
+
+    def __init__(self,topic,config):
+        self.__parse_config(config)
+
+        self.config = config
+        self.__topic = topic
+        self.__request_topic = topic + '/history/get'
+        self.__response_topic = topic + '/history'
+
+        self.__lock = Lock()
+        self.__started = False
+        self.__times = array(HISTORY_TIME,[0]) * self.__size
+        self.__values = array(HISTORY_VALUE,[0]) * self.__size
+        self.__count = 0
+        self.__next = 0
+        self.__stored = clock.monotonic()
+
+        self.__path = None
+        if self.__directory is not None:
+            self.__path = os.path.join(self.__directory,topic.replace('/','_') + '.history')
+            self.__load()
+
+        metrics.gauge('history_bytes',topic=topic).set(self.__size * HISTORY_SAMPLE_SIZE)
+
+
+    def __parse_config(self,config):
+        self.__size = 3600
+        self.__directory = None
+        self.__snapshot = 300
+
+        if config is None:
+            return
+
+        if type(config) is not dict:
+            raise TypeError('"history" is not of type dict')
+
+        if 'size' in config:
+            if config['size'] < 1:
+                raise ValueError('"size" in the "history" object must be at least 1')
+            self.__size = config['size']
+
+        if 'directory' in config:
+            self.__directory = config['directory']
+
+        if 'snapshot' in config:
+            self.__snapshot = config['snapshot']
+
+
+    def __load(self):
+        try:
+            with open(self.__path,'rb') as f:
+                magic, size, count, _next = HISTORY_HEADER.unpack(f.read(HISTORY_HEADER.size))
+                if magic != HISTORY_MAGIC or size != self.__size or count > size or _next >= size:
+                    logger.info(f'history {self.__path} does not match the configuration, starting empty')
+                    return
+                times = array(HISTORY_TIME)
+                values = array(HISTORY_VALUE)
+                times.fromfile(f,size)
+                values.fromfile(f,size)
+        except (OSError, EOFError, struct.error) as ex:
+            logger.info(f'history {self.__path} not loaded: {ex}')
+            return
+
+        self.__times = times
+        self.__values = values
+        self.__count = count
+        self.__next = _next
+        logger.info(f'history {self.__path} loaded with {count} samples')
+
+
+    def store(self):
+        if self.__path is None:
+            return
+
+        with self.__lock:
+            header = HISTORY_HEADER.pack(HISTORY_MAGIC,self.__size,self.__count,self.__next)
+            data = header + self.__times.tobytes() + self.__values.tobytes()
+            self.__stored = clock.monotonic()
+
+        try:
+            os.makedirs(self.__directory,exist_ok=True)
+            atomic_write(self.__path,data)
+        except OSError as ex:
+            logger.warning(f'history {self.__path} not stored: {ex}')
+
+
+    def add(self,value,timestamp=None):
+        if timestamp is None:
+            timestamp = clock.time()
+
+        with self.__lock:
+            self.__times[self.__next] = int(timestamp)
+            self.__values[self.__next] = value
+            self.__next = (self.__next + 1) % self.__size
+            self.__count = min(self.__count + 1,self.__size)
+            due = self.__snapshot is not None and clock.monotonic() - self.__stored >= self.__snapshot
+
+        if due:
+            self.store()
+
+
+    # Returns the (time, value) samples between start and end, averaged down
+    # to at most points samples.
+    def query(self,start,end,points) -> list:
+        with self.__lock:
+            if self.__count < self.__size:
+                times = self.__times[:self.__count]
+                values = self.__values[:self.__count]
+            else:
+                times = self.__times[self.__next:] + self.__times[:self.__next]
+                values = self.__values[self.__next:] + self.__values[:self.__next]
+
+        samples = [(t,v) for t, v in zip(times,values) if start <= t <= end]
+        if len(samples) <= points:
+            return samples
+
+        width = math.ceil(len(samples) / points)
+        result = []
+        for index in range(0,len(samples),width):
+            chunk = samples[index:index + width]
+            result.append((sum([t for t, v in chunk]) / len(chunk),sum([v for t, v in chunk]) / len(chunk)))
+        return result
+
+
+    # The request is an optional JSON object of start and end times, times
+    # up to zero being relative to now, and the number of points. The
+    # response has the format of a batch.
+    def __on_request(self,client,userdata,message):
+        now = clock.time()
+        start = 0
+        end = now
+        points = HISTORY_POINTS
+
+        try:
+            request = json.loads(message.payload) if message.payload else {}
+            if type(request) is not dict:
+                raise TypeError('the request is not an object')
+            if request.get('start') is not None:
+                start = request['start'] if request['start'] > 0 else now + request['start']
+            if request.get('end') is not None:
+                end = request['end'] if request['end'] > 0 else now + request['end']
+            if 'points' in request:
+                points = max(1,min(int(request['points']),BATCH_MAX_SAMPLES))
+        except (ValueError, TypeError) as ex:
+            logger.warning(f'{self.__request_topic}: invalid request ({ex})')
+            return
+
+        samples = self.query(start,end,points)
+        payload = bytearray(BATCH_HEADER.pack(BATCH_VERSION,len(samples)))
+        for t, v in samples:
+            payload += BATCH_SAMPLE.pack(t,v)
+
+        logger.debug('%s: responding with %s samples',self.__request_topic,len(samples))
+        Mqtt.instance().publish(self.__response_topic,bytes(payload))
+        metrics.counter('history_requests_total',topic=self.__topic).inc()
+
+
+    def __subscribe(self):
+        Mqtt.instance().subscribe(self.__request_topic,qos=1)
+        Mqtt.instance().message_callback_add(self.__request_topic,self.__on_request)
+
+
+    def __on_connect(self,client,userdata,flags,rc):
+        if rc == mqtt.client.CONNACK_ACCEPTED:
+            self.__subscribe()
+
+
+    def start(self):
+        self.__started = True
+        Mqtt.instance().register_on_connect(self.__on_connect)
+        if Mqtt.instance().is_connected():
+            self.__subscribe()
+
+
+    def stop(self):
+        if not self.__started:
+            return
+        self.__started = False
+        Mqtt.instance().unregister_on_connect(self.__on_connect)
+        Mqtt.instance().message_callback_remove(self.__request_topic)
+        if Mqtt.instance().is_connected():
+            Mqtt.instance().unsubscribe(self.__request_topic)
+        self.store()
@@ -0,0 +1,192 @@
+from .logger import logger
+from .gpio import Gpio, gpio
+from .metrics import metrics
+from .clock import clock
+from .trace import I2C_ZIP_ADDRESS, I2C_ZIP_READ, I2C_ZIP_END
+
+from threading import Condition, Lock
+import time
+
+
+# Hands the bus out in the order it was asked for, so a sensor reading at a
+# high rate cannot starve another one on the same bus.
+class FairLock():
+
+    def __init__(self,bus):
+        self.__cond = Condition()
+        self.__next = 0
+        self.__serving = 0
+        self.__wait = metrics.histogram('i2c_bus_wait_seconds',bus=bus)
+
+
+    def __enter__(self):
+        with self.__cond:
+            ticket = self.__next
+            self.__next += 1
+            if ticket != self.__serving:
+                start = time.perf_counter()
+                while ticket != self.__serving:
+                    self.__cond.wait()
+                self.__wait.observe(time.perf_counter() - start)
+        return self
+
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        with self.__cond:
+            self.__serving += 1
+            self.__cond.notify_all()
+
+
+class I2cDevice():
+
+    def __init__(self,bus,addr,size,frames,handle):
+        self.bus = bus
+        self.addr = addr
+        self.size = size
+        self.frames = frames
+        self.handle = handle
+        # (time, data) read for this device by another device's transaction.
+        self.pending = None
+
+
+    # Returns (count, data) like i2c_read_device, data holding every frame.
+    def read(self) -> ():
+        return I2cBus.instance().read(self)
+
+
+    def close(self):
+        I2cBus.instance().close_device(self)
+
+
+# Shares the I2C buses between the sensors. Handles are opened once per
+# device and kept across sensor restarts, and a read of one device also
+# reads the other devices on its bus in the same i2c_zip call, so several
+# sensors cost a single pigpiod round trip.
+class I2cBus():
+    __instance = None
+
+
+    @staticmethod
+    def instance():
+        if I2cBus.__instance is None:
+            raise Exception('Instance has not been created.')
+
+        return I2cBus.__instance
+
+
+    def __init__(self,config):
+        if I2cBus.__instance is not None:
+            raise Exception('Singleton instance already created.')
+
+        self.__parse_config(config)
+
+        self.__lock = Lock()
+        self.__handles = {}
+        self.__buses = {}
+        self.__devices = {}
+
+        I2cBus.__instance = self
+
+
+    def __parse_config(self,config):
+        self.__max_age = 0.1
+
+        if config is not None and 'i2c' in config:
+            if 'max_age' in config['i2c']:
+                self.__max_age = config['i2c']['max_age']
+
+
+    def __channel(self):
+        return Gpio.instance().channel('i2c')
+
+
+    def __handle(self,bus,addr) -> int:
+        handle = self.__handles.get((bus,addr))
+        if handle is None:
+            handle = self.__channel().i2c_open(bus,addr)
+            self.__handles[(bus,addr)] = handle
+        return handle
+
+
+    def device(self,bus,addr,size,frames=1) -> I2cDevice:
+        with self.__lock:
+            device = I2cDevice(bus,addr,size,frames,self.__handle(bus,addr))
+            if not bus in self.__buses:
+                self.__buses[bus] = FairLock(bus)
+                self.__devices[bus] = []
+            self.__devices[bus].append(device)
+
+        return device
+
+
+    def close_device(self,device):
+        with self.__lock:
+            if device in self.__devices.get(device.bus,[]):
+                self.__devices[device.bus].remove(device)
+
+
+    def __commands(self,devices) -> bytes:
+        commands = bytearray()
+        for device in devices:
+            commands += bytes([I2C_ZIP_ADDRESS,device.addr])
+            commands += bytes([I2C_ZIP_READ,device.size] * device.frames)
+        commands.append(I2C_ZIP_END)
+        return bytes(commands)
+
+
+    def __read_device(self,device) -> ():
+        if device.frames == 1:
+            return self.__channel().i2c_read_device(device.handle,device.size)
+        return self.__channel().i2c_zip(device.handle,self.__commands([device]))
+
+
+    def read(self,device) -> ():
+        with self.__buses[device.bus]:
+            now = clock.monotonic()
+            if device.pending is not None:
+                taken, data = device.pending
+                device.pending = None
+                if now - taken <= self.__max_age:
+                    metrics.counter('i2c_bus_prefetched_total',bus=device.bus).inc()
+                    return (len(data),data)
+
+            others = []
+            if self.__max_age > 0:
+                with self.__lock:
+                    others = [other for other in self.__devices[device.bus] if other is not device]
+            if not others:
+                return self.__read_device(device)
+
+            devices = [device] + others
+            # A device that does not answer fails the whole transaction.
+            try:
+                count, data = self.__channel().i2c_zip(device.handle,self.__commands(devices))
+            except gpio.error as ex:
+                logger.debug('i2c bus %s: batched read failed (%s)',device.bus,ex)
+                return self.__read_device(device)
+            if count != sum([other.size * other.frames for other in devices]):
+                logger.debug('i2c bus %s: batched read returned %s bytes',device.bus,count)
+                return self.__read_device(device)
+
+            offset = 0
+            for other in devices:
+                length = other.size * other.frames
+                if other is device:
+                    result = data[offset:offset + length]
+                else:
+                    other.pending = (now,data[offset:offset + length])
+                offset += length
+
+            return (len(result),result)
+
+
+    def close(self):
+        with self.__lock:
+            handles = list(self.__handles.values())
+            self.__handles = {}
+
+        for handle in handles:
+            try:
+                self.__channel().i2c_close(handle)
+            except gpio.error as ex:
+                logger.warning(f'i2c handle {handle} not closed ({ex})')
@@ -0,0 +1,172 @@
+from .logger import logger
+
+from threading import Lock
+import mmap
+import os
+import struct
+import time
+
+
+JOURNAL_MAGIC = b'GJN1'
+
+# magic, data capacity, head offset, tail offset
+JOURNAL_HEADER = struct.Struct('<4sIII')
+
+# record length, time, qos, retain, topic length
+JOURNAL_RECORD = struct.Struct('<HdBBH')
+
+
+class Journal():
+
+    def __init__(self,path,size):
+        if size <= JOURNAL_HEADER.size + JOURNAL_RECORD.size:
+            raise ValueError(f'journal size {size} is too small')
+
+        self.__lock = Lock()
+        self.__capacity = size - JOURNAL_HEADER.size
+        self.__dropped = 0
+        self.__peeked = None
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory,exist_ok=True)
+
+        fd = os.open(path,os.O_RDWR | os.O_CREAT,0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd,size)
+            self.__mm = mmap.mmap(fd,size)
+        finally:
+            os.close(fd)
+
+        magic, capacity, self.__head, self.__tail = JOURNAL_HEADER.unpack_from(self.__mm,0)
+        if magic != JOURNAL_MAGIC or capacity != self.__capacity \
+                or self.__head >= capacity or self.__tail >= capacity:
+            logger.info(f'journal {path} initialized with {self.__capacity} bytes')
+            self.__head = 0
+            self.__tail = 0
+            self.__store_header()
+        elif not self.empty():
+            logger.info(f'journal {path} has pending records')
+
+
+    def __store_header(self):
+        JOURNAL_HEADER.pack_into(self.__mm,0,JOURNAL_MAGIC,self.__capacity,self.__head,self.__tail)
+
+
+    def __offset(self,position) -> int:
+        return JOURNAL_HEADER.size + position
+
+
+    # A record that does not fit before the end of the ring is preceded by a
+    # zero length marker, or by nothing if fewer than two bytes remain.
+    def __wrapped(self,position) -> bool:
+        if self.__capacity - position < 2:
+            return True
+        return struct.unpack_from('<H',self.__mm,self.__offset(position))[0] == 0
+
+
+    def __drop_oldest(self):
+        if self.__wrapped(self.__tail):
+            self.__tail = 0
+        else:
+            self.__tail += struct.unpack_from('<H',self.__mm,self.__offset(self.__tail))[0]
+            if self.__tail == self.__capacity:
+                self.__tail = 0
+
+        if self.__tail == self.__head:
+            self.__head = 0
+            self.__tail = 0
+
+
+    def empty(self) -> bool:
+        return self.__head == self.__tail
+
+
+    def dropped(self) -> int:
+        return self.__dropped
+
+
+    def append(self,topic,payload,qos,retain) -> bool:
+        _topic = topic.encode()
+        length = JOURNAL_RECORD.size + len(_topic) + len(payload)
+
+        if length >= self.__capacity or length > 0xFFFF:
+            logger.warning(f'journal record for {topic} is too large ({length} bytes)')
+            return False
+
+        with self.__lock:
+            while True:
+                if self.__head >= self.__tail:
+                    # Keep a byte free so a full ring is not mistaken for empty.
+                    room = self.__capacity - self.__head - (1 if self.__tail == 0 else 0)
+                    if length <= room:
+                        break
+                    if self.__tail == 0:
+                        self.__drop_oldest()
+                        self.__dropped += 1
+                        continue
+                    if self.__capacity - self.__head >= 2:
+                        struct.pack_into('<H',self.__mm,self.__offset(self.__head),0)
+                    self.__head = 0
+                else:
+                    if length <= self.__tail - self.__head - 1:
+                        break
+                    self.__drop_oldest()
+                    self.__dropped += 1
+
+            offset = self.__offset(self.__head)
+            JOURNAL_RECORD.pack_into(self.__mm,offset,length,time.time(),qos,1 if retain else 0,len(_topic))
+            offset += JOURNAL_RECORD.size
+            self.__mm[offset:offset + len(_topic)] = _topic
+            offset += len(_topic)
+            self.__mm[offset:offset + len(payload)] = payload
+
+            self.__head += length
+            if self.__head == self.__capacity:
+                self.__head = 0
+            self.__store_header()
+
+        return True
+
+
+    # Returns (time, topic, payload, qos, retain) of the oldest record or None.
+    def peek(self) -> tuple:
+        with self.__lock:
+            if self.empty():
+                return None
+
+            if self.__wrapped(self.__tail):
+                self.__tail = 0
+                self.__store_header()
+
+            self.__peeked = self.__tail
+            offset = self.__offset(self.__tail)
+            length, _time, qos, retain, topic_length = JOURNAL_RECORD.unpack_from(self.__mm,offset)
+            offset += JOURNAL_RECORD.size
+            topic = bytes(self.__mm[offset:offset + topic_length]).decode()
+            offset += topic_length
+            payload = bytes(self.__mm[offset:offset + length - JOURNAL_RECORD.size - topic_length])
+
+            return (_time, topic, payload, qos, retain != 0)
+
+
+    # Removes the record returned by the last peek unless appending has
+    # already dropped it to make room.
+    def pop(self):
+        with self.__lock:
+            if self.empty() or self.__tail != self.__peeked:
+                return
+            self.__drop_oldest()
+            self.__store_header()
+
+
+    def sync(self):
+        with self.__lock:
+            self.__mm.flush()
+
+
+    def close(self):
+        with self.__lock:
+            self.__mm.flush()
+            self.__mm.close()
@@ -1,5 +1,10 @@
 import logging
 import logging.config
+import logging.handlers
+import atexit
+import queue
+import threading
+import time
 
 
 # Define the logging configuration
@@ -37,10 +42,141 @@ def custom_logger():
 logger = custom_logger()
 
 
+# Passes at most burst records per interval from each call site, ERROR and
+# above always passing. The count of suppressed records is added to the
+# next record let through.
+class RateLimitFilter(logging.Filter):
+
+    def __init__(self,interval=60.0,burst=10):
+        super().__init__()
+        self.__interval = interval
+        self.__burst = burst
+        self.__lock = threading.Lock()
+        self.__sites = {}
+
+
+    def filter(self,record) -> bool:
+        if record.levelno >= logging.ERROR:
+            return True
+
+        key = (record.pathname,record.lineno)
+        now = time.monotonic()
+        with self.__lock:
+            site = self.__sites.get(key)
+            if site is None or now - site[0] >= self.__interval:
+                suppressed = site[2] if site is not None else 0
+                site = [now,0,0]
+                self.__sites[key] = site
+            else:
+                suppressed = 0
+
+            if site[1] >= self.__burst:
+                site[2] += 1
+                return False
+            site[1] += 1
+
+        if suppressed:
+            record.msg = f'{record.getMessage()} ({suppressed} similar messages suppressed)'
+            record.args = None
+        return True
+
+
+# Hands records to the listener thread without blocking. When the queue is
+# full records are dropped and counted rather than stalling the caller.
+class AsyncHandler(logging.handlers.QueueHandler):
+
+    def __init__(self,queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+
+    def prepare(self,record):
+        # Merge the arguments now since they may change once the caller
+        # returns, leaving the formatting to the listener thread.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+    def enqueue(self,record):
+        try:
+            if self.dropped:
+                dropped = logging.makeLogRecord({
+                    'name': record.name,
+                    'levelno': logging.WARNING,
+                    'levelname': 'WARNING',
+                    'msg': f'{self.dropped} log records dropped'})
+                self.queue.put_nowait(dropped)
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class AsyncListener(logging.handlers.QueueListener):
+
+    # Waits for room rather than failing when the queue is full at exit.
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+__listener = None
+
+
+def __stop_listener():
+    global __listener
+
+    if __listener is not None:
+        __listener.stop()
+        __listener = None
+
+
+# Moves the root handlers behind a queue served by a single thread, so
+# callers never wait on the handlers' I/O.
+def __start_async(size,ratelimit):
+    global __listener
+
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    for handler in handlers:
+        root.removeHandler(handler)
+
+    handler = AsyncHandler(queue.Queue(size))
+    if ratelimit is not None:
+        handler.addFilter(ratelimit)
+    root.addHandler(handler)
+
+    __listener = AsyncListener(handler.queue,*handlers,respect_handler_level=True)
+    __listener.start()
+    atexit.register(__stop_listener)
+
+
 def parse_logger_config(config):
     if config is not None and 'logger' in config:
+        # async and ratelimit configure the pipeline rather than dictConfig.
+        _config = dict(config['logger'])
+        _async = _config.pop('async',None)
+        _ratelimit = _config.pop('ratelimit',None)
+
         try:
-            logging.config.dictConfig(config['logger'])
+            logging.config.dictConfig(_config)
             logger.critical("Logging was changed by configuration.")
         except (ValueError, TypeError, AttributeError, ImportError) as ex:
             logger.critical(f"{ex}")
+
+        # A filter counts every record it sees, so each handler gets its own.
+        ratelimit = None
+        if _ratelimit is not None:
+            ratelimit = lambda: RateLimitFilter(_ratelimit.get('interval',60.0),_ratelimit.get('burst',10))
+
+        if _async is not None and _async is not False:
+            size = 10000
+            if type(_async) is dict and 'queue' in _async:
+                size = _async['queue']
+            __start_async(size,ratelimit() if ratelimit is not None else None)
+        elif ratelimit is not None:
+            for handler in logging.getLogger().handlers:
+                handler.addFilter(ratelimit())
@@ -0,0 +1,209 @@
+from .logger import logger
+from .atomic import atomic_write
+
+from threading import Thread, Event, Lock
+import bisect
+import json
+import time
+
+
+METRICS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter():
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__value = 0
+
+
+    def inc(self,amount=1):
+        with self.__lock:
+            self.__value += amount
+
+
+    def samples(self) -> list:
+        return [('',{},self.__value)]
+
+
+class Gauge():
+
+    def __init__(self):
+        self.__value = 0
+
+
+    def set(self,value):
+        self.__value = value
+
+
+    def samples(self) -> list:
+        return [('',{},self.__value)]
+
+
+class Histogram():
+
+    def __init__(self,buckets=METRICS_BUCKETS):
+        self.__lock = Lock()
+        self.__buckets = buckets
+        self.__counts = [0] * (len(buckets) + 1)
+        self.__sum = 0.0
+        self.__count = 0
+
+
+    def observe(self,value):
+        index = bisect.bisect_left(self.__buckets,value)
+        with self.__lock:
+            self.__counts[index] += 1
+            self.__sum += value
+            self.__count += 1
+
+
+    def samples(self) -> list:
+        with self.__lock:
+            counts = list(self.__counts)
+            _sum = self.__sum
+            count = self.__count
+
+        samples = []
+        cumulative = 0
+        for bound, bucket in zip(self.__buckets,counts):
+            cumulative += bucket
+            samples.append(('_bucket',{'le': str(bound)},cumulative))
+        samples.append(('_bucket',{'le': '+Inf'},count))
+        samples.append(('_sum',{},_sum))
+        samples.append(('_count',{},count))
+        return samples
+
+
+class Timer():
+
+    def __init__(self,histogram):
+        self.__histogram = histogram
+
+
+    def __enter__(self):
+        self.__start = time.perf_counter()
+        return self
+
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.__histogram.observe(time.perf_counter() - self.__start)
+
+
+class Registry():
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__metrics = {}
+
+
+    def __get(self,kind,name,labels) -> object:
+        key = (name,tuple(sorted(labels.items())))
+        metric = self.__metrics.get(key)
+        if metric is None:
+            with self.__lock:
+                metric = self.__metrics.get(key)
+                if metric is None:
+                    metric = kind()
+                    self.__metrics[key] = metric
+        return metric
+
+
+    def counter(self,name,**labels) -> Counter:
+        return self.__get(Counter,name,labels)
+
+
+    def gauge(self,name,**labels) -> Gauge:
+        return self.__get(Gauge,name,labels)
+
+
+    def histogram(self,name,**labels) -> Histogram:
+        return self.__get(Histogram,name,labels)
+
+
+    def timer(self,name,**labels) -> Timer:
+        return Timer(self.histogram(name,**labels))
+
+
+    def __labels(self,labels) -> str:
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+    def prometheus(self) -> str:
+        with self.__lock:
+            metrics = sorted(self.__metrics.items(),key=lambda item: item[0])
+
+        lines = []
+        typed = set()
+        for (name, labels), metric in metrics:
+            if not name in typed:
+                lines.append(f'# TYPE {name} {type(metric).__name__.lower()}')
+                typed.add(name)
+            for suffix, extra, value in metric.samples():
+                lines.append(f'{name}{suffix}{self.__labels(dict(labels,**extra))} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+    def snapshot(self) -> dict:
+        with self.__lock:
+            metrics = list(self.__metrics.items())
+
+        snapshot = {}
+        for (name, labels), metric in metrics:
+            for suffix, extra, value in metric.samples():
+                snapshot[f'{name}{suffix}{self.__labels(dict(labels,**extra))}'] = value
+        return snapshot
+
+
+metrics = Registry()
+
+
+class MetricsExporter(Thread):
+
+    def __init__(self,config,publish):
+        self.__parse_config(config)
+
+        self.__publish = publish
+        self.__stop = Event()
+
+        super().__init__(target=self.__run)
+
+
+    def __parse_config(self,config):
+        self.__interval = 60
+        self.__topic = None
+        self.__textfile = None
+
+        if config is not None and 'metrics' in config:
+            if 'interval' in config['metrics']:
+                self.__interval = config['metrics']['interval']
+            if 'topic' in config['metrics']:
+                self.__topic = config['metrics']['topic']
+            if 'textfile' in config['metrics']:
+                self.__textfile = config['metrics']['textfile']
+
+
+    def __export(self):
+        if self.__topic is not None:
+            self.__publish(self.__topic,json.dumps(metrics.snapshot()),conflate=True)
+
+        if self.__textfile is not None:
+            try:
+                atomic_write(self.__textfile,metrics.prometheus())
+            except OSError as ex:
+                logger.warning(f'metrics textfile {self.__textfile} not written: {ex}')
+
+
+    def __run(self):
+        logger.info(f'metrics exporter started with interval {self.__interval}')
+
+        while not self.__stop.wait(self.__interval):
+            self.__export()
+
+
+    def stop(self):
+        self.__stop.set()
+        if self.is_alive():
+            self.join()
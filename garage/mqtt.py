@@ -1,8 +1,13 @@
 import ssl
-from threading import Lock
+import time
+from threading import Lock, Thread
 import paho
 from paho.mqtt.client import Client
 from .logger import logger
+from .journal import Journal
+from .batch import Batcher
+from .outbox import Outbox, published
+from .metrics import metrics
 
 
 class Mqtt(Client):
@@ -26,11 +31,33 @@ class Mqtt(Client):
         self.__on_connect_list_lock = Lock()
         self.__on_connect_list = []
 
-        super().__init__(self.__client_id)
+        self.__journal = None
+        self.__journal_lock = Lock()
+        self.__replaying = False
+        self.__replay_thread = None
+        if self.__journal_path is not None:
+            self.__journal = Journal(self.__journal_path,self.__journal_size)
+
+        self.__batcher = None
+        if self.__batch_interval is not None:
+            self.__batcher = Batcher(self.__batch_interval,self.publish)
+
+        self.__outbox = None
+        if self.__outbox_config is not None:
+            self.__outbox = Outbox(self.__outbox_config,self.__send,self.__outbox_ready)
+
+        super().__init__(self.__client_id,clean_session=self.__clean_session)
 
         self.enable_logger(logger)
 
+        # The broker publishes the offline message for us if the connection
+        # is lost without a disconnect.
+        if self.__availability is not None:
+            self.will_set(self.__availability,self.__offline,qos=1,retain=True)
+
         self.on_connect = self.__on_connect
+        if self.__outbox is not None:
+            self.on_publish = self.__on_publish
 
         Mqtt.__instance = self
 
@@ -42,6 +69,17 @@ class Mqtt(Client):
         self.__ca = None
         self.__client_ca = None
         self.__client_key = None
+        self.__journal_path = None
+        self.__journal_size = 1048576
+        self.__journal_rate = 50
+        self.__batch_interval = None
+        self.__outbox_config = None
+        self.__outbox_backlog = 100
+        self.__clean_session = True
+        self.__retain = False
+        self.__availability = None
+        self.__online = 'online'
+        self.__offline = 'offline'
 
         if config is not None and 'mqtt' in config:
             if 'clientid' in config['mqtt']:
@@ -57,25 +95,213 @@ class Mqtt(Client):
                     self.__client_ca = config['mqtt']['tls']['client_ca']
                 if 'client_key' in config['mqtt']['tls']:
                     self.__client_key = config['mqtt']['tls']['client_key']
+            if 'journal' in config['mqtt']:
+                if not 'path' in config['mqtt']['journal']:
+                    raise ValueError('"path" missing from the "journal" object in the configuration')
+                self.__journal_path = config['mqtt']['journal']['path']
+                if 'size' in config['mqtt']['journal']:
+                    self.__journal_size = config['mqtt']['journal']['size']
+                if 'rate' in config['mqtt']['journal']:
+                    self.__journal_rate = config['mqtt']['journal']['rate']
+            if 'batch' in config['mqtt']:
+                if not 'interval' in config['mqtt']['batch']:
+                    raise ValueError('"interval" missing from the "batch" object in the configuration')
+                self.__batch_interval = config['mqtt']['batch']['interval']
+            if 'outbox' in config['mqtt']:
+                self.__outbox_config = config['mqtt']['outbox']
+                if type(self.__outbox_config) is dict and 'backlog' in self.__outbox_config:
+                    self.__outbox_backlog = self.__outbox_config['backlog']
+            if 'clean_session' in config['mqtt']:
+                self.__clean_session = config['mqtt']['clean_session']
+            if 'retain' in config['mqtt']:
+                if type(config['mqtt']['retain']) not in [bool,list]:
+                    raise TypeError('"retain" in the "mqtt" object is not a bool or a list')
+                self.__retain = config['mqtt']['retain']
+            if 'availability' in config['mqtt']:
+                if not 'topic' in config['mqtt']['availability']:
+                    raise ValueError('"topic" missing from the "availability" object in the configuration')
+                self.__availability = config['mqtt']['availability']['topic']
+                if 'online' in config['mqtt']['availability']:
+                    self.__online = config['mqtt']['availability']['online']
+                if 'offline' in config['mqtt']['availability']:
+                    self.__offline = config['mqtt']['availability']['offline']
+
+        # The broker keys a persistent session by the client id.
+        if not self.__clean_session and not self.__client_id:
+            raise ValueError('"clientid" missing from the "mqtt" object, a persistent session needs one')
 
     
     def __on_connect(self, client, userdata, flags, rc):
+        if rc == mqtt.client.CONNACK_ACCEPTED and self.__availability is not None:
+            self.__send(self.__availability,self.__online,1,True)
+        if rc == mqtt.client.CONNACK_ACCEPTED and self.__journal is not None:
+            self.__start_replay()
+        if rc == mqtt.client.CONNACK_ACCEPTED and self.__outbox is not None:
+            self.__outbox.wake()
+
         with self.__on_connect_list_lock:
             for fn in self.__on_connect_list:
                 fn(client, userdata, flags, rc)
     
 
+    # paho sent a message or had it acknowledged, so its backlog shrank.
+    def __on_publish(self, client, userdata, mid):
+        self.__outbox.wake()
+
+
     def connect(self):
         logger.info(f"Connecting to {self.__host} port {self.__port}")
         if not self.__ca is None:
             self.tls_set(ca_certs=self.__ca,certfile=self.__client_ca,keyfile=self.__client_key,tls_version=ssl.PROTOCOL_TLSv1_2)
         self.connect_async(self.__host,port=self.__port)
         self.loop_start()
+        if self.__outbox is not None:
+            self.__outbox.start()
+        if self.__batcher is not None:
+            self.__batcher.start()
 
     def disconnect(self):
         logger.info("Disconnect")
+        if self.__batcher is not None:
+            self.__batcher.stop()
+        if self.__outbox is not None:
+            self.__outbox.stop()
+        if self.__availability is not None and self.is_connected():
+            self.__send(self.__availability,self.__offline,1,True)
         super().disconnect()
         self.loop_stop()
+        if self.__replay_thread is not None:
+            self.__replay_thread.join()
+        if self.__journal is not None:
+            self.__journal.close()
+
+
+    def __payload_bytes(self, payload) -> bytes:
+        if payload is None:
+            return b''
+        if isinstance(payload, (bytes, bytearray)):
+            return bytes(payload)
+        if isinstance(payload, str):
+            return payload.encode()
+        return str(payload).encode()
+
+
+    # The outbox only hands paho a message once paho has sent most of what it
+    # already has, so its backlog is all paho ever holds.
+    # State messages are retained with "retain": true, as are the topics
+    # matching a list of patterns.
+    def __retains(self, topic, state) -> bool:
+        if self.__retain is True:
+            return state
+        if self.__retain:
+            for sub in self.__retain:
+                if mqtt.client.topic_matches_sub(sub,topic):
+                    return True
+        return False
+
+
+    def __outbox_ready(self) -> bool:
+        return self.is_connected() and not self.__replaying \
+            and len(self._out_packet) + len(self._out_messages) < self.__outbox_backlog
+
+
+    def __send(self, topic, payload=None, qos=0, retain=False, properties=None):
+        with metrics.timer('mqtt_publish_seconds'):
+            info = super().publish(topic, payload, qos, retain, properties)
+
+        metrics.counter('mqtt_publish_total',rc=info.rc).inc()
+        metrics.gauge('mqtt_queue_depth').set(len(self._out_messages))
+
+        return info
+
+
+    # A state message, flagged by conflate, only matters for its latest
+    # value, so older pending messages to the same topic are replaced rather
+    # than sent. With a journal the other messages keep going through the
+    # journal instead of the outbox.
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None, conflate=False):
+        if not retain and self.__retains(topic,conflate):
+            retain = True
+
+        conflate = self.__outbox is not None and self.__outbox.conflates(topic,conflate)
+
+        if self.__journal is not None and not conflate:
+            # While disconnected or draining the journal, new messages are
+            # appended behind the pending ones to keep them in order.
+            with self.__journal_lock:
+                if not self.is_connected() or self.__replaying:
+                    self.__journal.append(topic,self.__payload_bytes(payload),qos,retain)
+                    metrics.counter('mqtt_journaled_total').inc()
+                    return None
+
+        if self.__outbox is not None and (conflate or self.__journal is None):
+            self.__outbox.put(topic,payload,qos,retain,properties,conflate)
+            return None
+
+        return self.__send(topic, payload, qos, retain, properties)
+
+
+    # Publishes a timestamped sample, batched into one binary message per
+    # topic per interval when batching is configured.
+    def sample(self, topic, value, timestamp=None):
+        if self.__batcher is None:
+            return self.publish(topic, value)
+
+        self.__batcher.add(topic, value, timestamp)
+
+
+    def is_journaled(self) -> bool:
+        return self.__journal is not None
+
+
+    def __start_replay(self):
+        with self.__journal_lock:
+            if self.__journal.empty():
+                return
+            if self.__replay_thread is not None and self.__replay_thread.is_alive():
+                return
+            self.__replaying = True
+            self.__replay_thread = Thread(target=self.__replay)
+            self.__replay_thread.start()
+
+
+    def __replay(self):
+        logger.info(f'Replaying journal at {self.__journal_rate} messages per second')
+
+        count = 0
+        while self.is_connected():
+            # Publish up to a second's worth of records in one burst.
+            deadline = time.monotonic() + 1.0
+            for _ in range(self.__journal_rate):
+                # Publish outside the lock, paho may call back into
+                # __on_connect with its own callback lock held.
+                with self.__journal_lock:
+                    record = self.__journal.peek()
+                    if record is None:
+                        self.__replaying = False
+                        break
+                _time, topic, payload, qos, retain = record
+                info = super().publish(topic, payload, qos, retain)
+                if not published(qos,info.rc):
+                    break
+                self.__journal.pop()
+                count += 1
+                if info.rc != mqtt.client.MQTT_ERR_SUCCESS:
+                    break
+
+            if not self.__replaying:
+                break
+
+            time.sleep(max(0,deadline - time.monotonic()))
+
+        with self.__journal_lock:
+            self.__replaying = False
+
+        if self.__outbox is not None:
+            self.__outbox.wake()
+
+        self.__journal.sync()
+        logger.info(f'Replayed {count} journal records, {self.__journal.dropped()} dropped')
 
 
     def register_on_connect(self,fn):
@@ -0,0 +1,202 @@
+from .logger import logger
+from .metrics import metrics
+
+from collections import deque, OrderedDict
+from threading import Thread, Condition, Event
+from paho.mqtt.client import topic_matches_sub, MQTT_ERR_SUCCESS, MQTT_ERR_QUEUE_SIZE
+import time
+
+
+OUTBOX_POLICIES = ['drop_oldest','drop_newest','block']
+
+# How long to back off after paho refused a message, giving the client time
+# to notice a lost connection.
+OUTBOX_POLL = 0.05
+
+# topic, payload, qos, retain, properties, conflated
+OUTBOX_TOPIC = 0
+OUTBOX_PAYLOAD = 1
+OUTBOX_QOS = 2
+OUTBOX_RETAIN = 3
+OUTBOX_PROPERTIES = 4
+OUTBOX_CONFLATED = 5
+
+
+# Whether paho took the message. A qos 1 or 2 message it could not send for
+# want of a connection is kept in its session and resent on reconnect, so
+# publishing it again would send it twice.
+def published(qos,rc) -> bool:
+    if rc == MQTT_ERR_SUCCESS:
+        return True
+    return qos > 0 and rc != MQTT_ERR_QUEUE_SIZE
+
+
+# Holds outgoing messages until the client is connected and paho's own
+# backlog has drained, so paho never queues more than a few messages. A
+# conflated topic has a single slot whose value newer publishes overwrite, so
+# a reconnect sends one message per such topic however long the outage was.
+# The slots go out first and do not count against the bounded queue of the
+# other messages.
+class Outbox(Thread):
+
+    def __init__(self,config,publish,ready):
+        self.__parse_config(config)
+
+        self.__publish = publish
+        self.__ready = ready
+
+        self.__stop = Event()
+        self.__cond = Condition()
+        self.__queue = deque()
+        self.__slots = OrderedDict()
+
+        super().__init__(target=self.__run)
+
+
+    def __parse_config(self,config):
+        self.__size = 1000
+        self.__policy = 'drop_oldest'
+        self.__timeout = 1.0
+        self.__conflate = []
+
+        if config is None:
+            return
+
+        if type(config) is not dict:
+            raise TypeError('"outbox" is not of type dict')
+
+        if 'queue' in config:
+            if config['queue'] < 1:
+                raise ValueError('"queue" in the "outbox" object must be at least 1')
+            self.__size = config['queue']
+
+        if 'policy' in config:
+            if not config['policy'] in OUTBOX_POLICIES:
+                raise ValueError(f'"policy" in the "outbox" object must be one of {OUTBOX_POLICIES}')
+            self.__policy = config['policy']
+
+        if 'timeout' in config:
+            self.__timeout = config['timeout']
+
+        if 'conflate' in config:
+            if type(config['conflate']) is not list:
+                raise TypeError('"conflate" in the "outbox" object is not a list')
+            self.__conflate = config['conflate']
+
+
+    # Whether a message to the topic only matters for its latest value.
+    def conflates(self,topic,conflate=False) -> bool:
+        if conflate:
+            return True
+        for sub in self.__conflate:
+            if topic_matches_sub(sub,topic):
+                return True
+        return False
+
+
+    # Called with the condition held when the queue is full.
+    def __make_room(self) -> bool:
+        if self.__policy == 'drop_newest':
+            return False
+
+        if self.__policy == 'block':
+            deadline = time.monotonic() + self.__timeout
+            while len(self.__queue) >= self.__size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self.__stop.is_set():
+                    return False
+                self.__cond.wait(remaining)
+            return True
+
+        self.__queue.popleft()
+        metrics.counter('mqtt_outbox_dropped_total',policy=self.__policy).inc()
+        return True
+
+
+    def put(self,topic,payload,qos=0,retain=False,properties=None,conflate=False) -> bool:
+        with self.__cond:
+            if conflate:
+                if topic in self.__slots:
+                    metrics.counter('mqtt_outbox_coalesced_total').inc()
+                self.__slots[topic] = [topic,payload,qos,retain,properties,True]
+                metrics.gauge('mqtt_outbox_depth').set(self.depth())
+                self.__cond.notify_all()
+                return True
+
+            if len(self.__queue) >= self.__size and not self.__make_room():
+                metrics.counter('mqtt_outbox_dropped_total',policy=self.__policy).inc()
+                logger.debug('outbox full, dropped message to %s',topic)
+                return False
+
+            self.__queue.append([topic,payload,qos,retain,properties,False])
+
+            metrics.gauge('mqtt_outbox_depth').set(self.depth())
+            self.__cond.notify_all()
+
+        return True
+
+
+    def depth(self) -> int:
+        return len(self.__slots) + len(self.__queue)
+
+
+    def __next(self):
+        with self.__cond:
+            while not self.__stop.is_set():
+                pending = self.__slots or self.__queue
+                if pending and self.__ready():
+                    if self.__slots:
+                        entry = self.__slots.popitem(last=False)[1]
+                    else:
+                        entry = self.__queue.popleft()
+                    metrics.gauge('mqtt_outbox_depth').set(self.depth())
+                    self.__cond.notify_all()
+                    return entry
+                # Woken by a put, a connect, a finished replay or paho
+                # having sent a message.
+                self.__cond.wait()
+        return None
+
+
+    # Puts a message paho refused back in front unless a newer value for
+    # its topic is already pending.
+    def __requeue(self,entry):
+        with self.__cond:
+            if not entry[OUTBOX_CONFLATED]:
+                self.__queue.appendleft(entry)
+            elif not entry[OUTBOX_TOPIC] in self.__slots:
+                self.__slots[entry[OUTBOX_TOPIC]] = entry
+                self.__slots.move_to_end(entry[OUTBOX_TOPIC],last=False)
+
+
+    def __run(self):
+        logger.info(f'outbox started with {self.__size} messages, {self.__policy} when full')
+
+        while True:
+            entry = self.__next()
+            if entry is None:
+                break
+
+            info = self.__publish(*entry[:OUTBOX_CONFLATED])
+            if not published(entry[OUTBOX_QOS],info.rc):
+                self.__requeue(entry)
+                # Give the client time to reconnect before trying again.
+                self.__stop.wait(OUTBOX_POLL)
+
+        if self.depth() > 0:
+            logger.info(f'outbox stopped with {self.depth()} messages unsent')
+
+
+    # Wakes the sender when the client has just connected or paho's backlog
+    # has shrunk.
+    def wake(self):
+        with self.__cond:
+            self.__cond.notify_all()
+
+
+    def stop(self):
+        with self.__cond:
+            self.__stop.set()
+            self.__cond.notify_all()
+        if self.is_alive():
+            self.join()
@@ -0,0 +1,64 @@
+from .logger import logger
+from .startup import startup
+
+import importlib
+
+try:
+    from importlib.metadata import entry_points
+except ImportError:
+    entry_points = None
+
+
+# Packages add sensor types by declaring entry points in this group, named by
+# the sensor type and pointing at the sensor class.
+SENSOR_ENTRY_POINTS = 'garage.sensors'
+
+# Sensor type to the module and class implementing it. A module is only
+# imported once a sensor of its type is configured.
+SENSOR_TYPES = {
+    'sm9514': ('.sm9514','SM9514'),
+    'garagedoor': ('.garagedoor','GarageDoor'),
+    'w1therm': ('.w1therm','W1Therm')
+}
+
+
+__classes = {}
+
+
+def __entry_point(name) -> object:
+    if entry_points is None:
+        return None
+
+    eps = entry_points()
+    if hasattr(eps,'select'):
+        eps = eps.select(group=SENSOR_ENTRY_POINTS)
+    else:
+        eps = eps.get(SENSOR_ENTRY_POINTS,[])
+
+    for ep in eps:
+        if ep.name == name:
+            return ep
+    return None
+
+
+# Returns the class for a sensor type, or None if the type is unknown or its
+# module does not load.
+def sensor_class(name) -> type:
+    if name in __classes:
+        return __classes[name]
+
+    cls = None
+    with startup.phase(f'import {name}'):
+        try:
+            if name in SENSOR_TYPES:
+                module, attr = SENSOR_TYPES[name]
+                cls = getattr(importlib.import_module(module,__package__),attr)
+            else:
+                ep = __entry_point(name)
+                if ep is not None:
+                    cls = ep.load()
+        except Exception:
+            logger.exception(f'Sensor type "{name}" could not be loaded')
+
+    __classes[name] = cls
+    return cls
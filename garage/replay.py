@@ -0,0 +1,288 @@
+from .logger import logger
+from .clock import clock
+from .gpio import Gpio, gpio
+from .trace import read_trace, i2c_channel, i2c_zip_reads, TRACE_NAME, TRACE_GPIO, TRACE_I2C, TRACE_W1, TRACE_W1_VALUE
+
+from threading import Thread, Event, Lock
+
+
+class ReplayCallback():
+
+    def __init__(self,replay,pin,edge,fn):
+        self.__replay = replay
+        self.pin = pin
+        self.edge = edge
+        self.fn = fn
+
+
+    def cancel(self):
+        self.__replay.remove_callback(self)
+
+
+class ReplayW1Sensor():
+
+    def __init__(self,replay,sensor_id):
+        self.__replay = replay
+        self.id = sensor_id
+        self.slave_prefix = '28-'
+        self.sensorpath = None
+
+
+    # Returns None until the trace has a reading for the sensor.
+    def get_temperature(self,unit=None) -> float:
+        return self.__replay.w1_value(self.id)
+
+
+# Plays a trace recorded by the Recorder back against the clock, which the
+# replay speeds up by its speed.
+class Replay(Thread):
+    __instance = None
+
+
+    @staticmethod
+    def instance():
+        if Replay.__instance is None:
+            raise Exception('Instance has not been created.')
+
+        return Replay.__instance
+
+
+    @staticmethod
+    def enabled() -> bool:
+        return Replay.__instance is not None
+
+
+    def __init__(self,config,on_end=None):
+        if Replay.__instance is not None:
+            raise Exception('Singleton instance already created.')
+
+        self.__parse_config(config)
+
+        self.__on_end = on_end
+        self.__stop = Event()
+        self.__lock = Lock()
+        self.__levels = 0
+        self.__i2c = {}
+        self.__names = {}
+        self.__w1 = {}
+        self.__callbacks = []
+        self.__records = 0
+
+        clock.set_scale(self.__speed)
+
+        self.__trace = read_trace(self.__path)
+        self.__next = next(self.__trace,None)
+        self.__base = clock.monotonic()
+        self.__offset = 0.0
+        self.__end = 0.0
+
+        # Apply the state at the start of the trace so the sensors see it
+        # from their first read.
+        while self.__next is not None and self.__next[0] <= 0:
+            self.__apply(self.__next)
+            self.__next = next(self.__trace,None)
+
+        super().__init__(target=self.__run)
+
+        Replay.__instance = self
+
+
+    def __parse_config(self,config):
+        self.__path = None
+        self.__speed = 1.0
+        self.__loop = False
+
+        if config is None or not 'replay' in config:
+            raise ValueError('"replay" object missing from the confiugration')
+
+        if not 'path' in config['replay']:
+            raise ValueError('"path" missing from the "replay" object in the configuration')
+        self.__path = config['replay']['path']
+
+        if 'speed' in config['replay']:
+            self.__speed = config['replay']['speed']
+
+        if 'loop' in config['replay']:
+            self.__loop = config['replay']['loop']
+
+
+    def __apply(self,record):
+        offset, kind, channel, data = record
+        self.__records += 1
+
+        if kind == TRACE_GPIO:
+            with self.__lock:
+                mask = 1 << channel
+                previous = self.__levels & mask
+                if data[0]:
+                    self.__levels |= mask
+                else:
+                    self.__levels &= ~mask
+                changed = previous != (self.__levels & mask)
+                callbacks = [cb for cb in self.__callbacks if cb.pin == channel]
+
+            if not changed:
+                return
+            tick = int(clock.monotonic() * 1000000) & 0xFFFFFFFF
+            for cb in callbacks:
+                if cb.edge == gpio.EITHER_EDGE or (cb.edge == gpio.RISING_EDGE) == bool(data[0]):
+                    cb.fn(channel,data[0],tick)
+
+        elif kind == TRACE_I2C:
+            self.__i2c[channel] = data
+
+        elif kind == TRACE_NAME:
+            self.__names[channel] = data.decode()
+
+        elif kind == TRACE_W1:
+            if channel in self.__names:
+                self.__w1[self.__names[channel]] = TRACE_W1_VALUE.unpack(data)[0]
+
+
+    def __run(self):
+        logger.info(f'replaying {self.__path} at {self.__speed}x')
+
+        while not self.__stop.is_set():
+            if self.__next is None:
+                if not self.__loop:
+                    break
+                # Start over from the end of the previous pass.
+                self.__trace = read_trace(self.__path)
+                self.__next = next(self.__trace,None)
+                self.__offset = self.__end
+                if self.__next is None:
+                    break
+
+            offset = self.__offset + self.__next[0]
+            delay = self.__base + offset - clock.monotonic()
+            if delay > 0 and clock.wait(self.__stop,delay):
+                break
+
+            self.__apply(self.__next)
+            self.__end = offset
+            self.__next = next(self.__trace,None)
+
+        logger.info(f'replay of {self.__path} ended after {self.__records} records')
+
+        if not self.__stop.is_set() and self.__on_end is not None:
+            self.__on_end()
+
+
+    def stop(self):
+        self.__stop.set()
+        if self.is_alive():
+            self.join()
+
+
+    def level(self,pin) -> int:
+        return (self.__levels >> pin) & 1
+
+
+    def levels(self) -> int:
+        return self.__levels
+
+
+    def add_callback(self,pin,edge,fn) -> ReplayCallback:
+        cb = ReplayCallback(self,pin,edge,fn)
+        with self.__lock:
+            self.__callbacks.append(cb)
+        return cb
+
+
+    def remove_callback(self,cb):
+        with self.__lock:
+            if cb in self.__callbacks:
+                self.__callbacks.remove(cb)
+
+
+    def i2c_data(self,bus,addr) -> bytes:
+        return self.__i2c.get(i2c_channel(bus,addr))
+
+
+    def w1_sensor(self,sensor_id) -> ReplayW1Sensor:
+        return ReplayW1Sensor(self,sensor_id)
+
+
+    def w1_value(self,sensor_id) -> float:
+        return self.__w1.get(sensor_id)
+
+
+# A Gpio backed by a Replay instead of pigpiod. Outputs are accepted and
+# logged, inputs and I2C reads come from the trace.
+class ReplayGpio(Gpio):
+
+    def _connect(self, host, port):
+        self.__handles = {}
+        self.connected = True
+
+
+    def _open_channel(self, name, host, port):
+        return self
+
+
+    def read(self, gpio):
+        return Replay.instance().level(gpio)
+
+
+    def write(self, gpio, level):
+        logger.debug('replay write gpio %s %s',gpio,level)
+        return 0
+
+
+    def read_bank_1(self):
+        return Replay.instance().levels()
+
+
+    def set_mode(self, gpio, mode):
+        return 0
+
+
+    def set_glitch_filter(self, user_gpio, steady):
+        return 0
+
+
+    def set_noise_filter(self, user_gpio, steady, active):
+        return 0
+
+
+    def store_script(self, script):
+        raise gpio.error('scripts are not replayed')
+
+
+    def callback(self, user_gpio, edge=gpio.RISING_EDGE, func=None):
+        return Replay.instance().add_callback(user_gpio,edge,func)
+
+
+    def i2c_open(self, i2c_bus, i2c_address, i2c_flags=0):
+        handle = len(self.__handles)
+        self.__handles[handle] = (i2c_bus,i2c_address)
+        return handle
+
+
+    def i2c_close(self, handle):
+        self.__handles.pop(handle,None)
+        return 0
+
+
+    def i2c_read_device(self, handle, count):
+        data = Replay.instance().i2c_data(*self.__handles[handle])
+        if data is None:
+            return (gpio.PI_I2C_READ_FAILED,bytearray())
+        return (min(count,len(data)),bytearray(data[:count]))
+
+
+    # Only the reads of the command list are replayed, each one taking the
+    # bytes last recorded for the device it addresses.
+    def i2c_zip(self, handle, data):
+        bus, addr = self.__handles[handle]
+        result = bytearray()
+        for addr, count in i2c_zip_reads(data,addr):
+            recorded = Replay.instance().i2c_data(bus,addr)
+            if recorded is None:
+                return (gpio.PI_I2C_READ_FAILED,bytearray())
+            result += recorded[:count]
+        return (len(result),result)
+
+
+    def stop(self):
+        pass
@@ -0,0 +1,154 @@
+from .logger import logger
+from .metrics import metrics, Timer
+from .clock import clock
+
+from threading import Thread, Event, Lock
+import json
+import math
+
+
+# The payload of a sample published with its acquisition time, both the wall
+# clock and the monotonic clock.
+def sample_payload(value,acquired) -> str:
+    return json.dumps({'value': value,'time': round(acquired[0],3),'monotonic': round(acquired[1],3)})
+
+
+class Sensor(Thread):
+
+    def __init__(self,name=None):
+        self.__stop = Event()
+        self.__wake = Event()
+
+        self.__waker = None
+
+        self.__deadline = None
+        self.__scheduled = None
+        self.__started = None
+
+        self.__on_exit_list_lock = Lock()
+        self.__on_exit_list = []
+
+        super().__init__(target=self.__run,name=name)
+
+        self.__step_histogram = metrics.histogram('sensor_step_seconds',sensor=self.name)
+        self.__jitter_histogram = metrics.histogram('sensor_jitter_seconds',sensor=self.name)
+        self.__overrun_histogram = metrics.histogram('sensor_overrun_seconds',sensor=self.name)
+        self.__overrun_counter = metrics.counter('sensor_overruns_total',sensor=self.name)
+
+
+    # Prepare the sensor, returning False if it cannot run.
+    def setup(self) -> bool:
+        return True
+
+
+    # Run one iteration, returning the seconds to sleep before the next
+    # iteration or None to end the sensor.
+    def step(self) -> float:
+        raise NotImplementedError
+
+
+    def teardown(self):
+        pass
+
+
+    def set_waker(self,fn):
+        self.__waker = fn
+
+
+    def wake(self):
+        self.__wake.set()
+        if self.__waker is not None:
+            self.__waker()
+
+
+    def stopping(self) -> bool:
+        return self.__stop.is_set()
+
+
+    # The time a sample was acquired, as (wall clock, monotonic).
+    def acquired(self) -> tuple:
+        return (clock.time(),clock.monotonic())
+
+
+    # Returns the delay from now to the next deadline on a fixed grid of
+    # period, for step() to return. Time spent in step() does not add to the
+    # period. A step that runs past a deadline skips the periods it missed,
+    # which are counted as overruns.
+    def every(self,period) -> float:
+        now = clock.monotonic()
+        if self.__deadline is None:
+            # The grid starts with the first step.
+            self.__deadline = self.__started if self.__started is not None else now
+
+        self.__deadline += period
+        if self.__deadline < now:
+            self.__overrun_histogram.observe(now - self.__deadline)
+            missed = math.floor((now - self.__deadline) / period) + 1
+            self.__overrun_counter.inc(missed)
+            self.__deadline += missed * period
+
+        self.__scheduled = self.__deadline
+        return self.__deadline - now
+
+
+    # Runs step() and records how long it took, and how late it started if
+    # it was scheduled by every().
+    def run_step(self) -> float:
+        self.__started = clock.monotonic()
+        scheduled = self.__scheduled
+        self.__scheduled = None
+        if scheduled is not None:
+            late = self.__started - scheduled
+            # An early start was a wake().
+            if late >= 0:
+                self.__jitter_histogram.observe(late)
+
+        with Timer(self.__step_histogram):
+            return self.step()
+
+
+    def register_on_exit(self,fn):
+        with self.__on_exit_list_lock:
+            if fn in self.__on_exit_list:
+                logger.warning(f'Function {fn} already registered')
+                return
+            self.__on_exit_list.append(fn)
+
+
+    # Called by whatever runs the sensor once it has ended, with the reason
+    # it ended or None when it was stopped.
+    def notify_exit(self,reason):
+        with self.__on_exit_list_lock:
+            for fn in self.__on_exit_list:
+                fn(reason)
+
+
+    def __run(self):
+        reason = 'ended'
+        try:
+            # A setup that fails part way is undone by the teardown too.
+            try:
+                if not self.setup():
+                    reason = 'setup failed'
+                    return
+
+                while not self.__stop.is_set():
+                    self.__wake.clear()
+                    delay = self.run_step()
+                    if delay is None:
+                        break
+                    clock.wait(self.__wake,delay)
+            finally:
+                self.teardown()
+        except Exception as ex:
+            reason = repr(ex)
+            raise
+        finally:
+            self.notify_exit(None if self.__stop.is_set() else reason)
+
+
+    def stop(self):
+        self.__stop.set()
+        self.wake()
+        if self.is_alive():
+            self.join()
@@ -1,10 +1,18 @@
 from .logger import logger
 from .mqtt import Mqtt, mqtt
-from .gpio import Gpio, gpio
-
-from threading import Thread, Event
-import time
+from .i2cbus import I2cBus
+from .sensor import Sensor, sample_payload
+from .deadband import Deadband
+from .history import History
+from .metrics import metrics
+from .clock import clock
+
+from array import array
 import binascii
+import json
+import logging
+import math
+import operator
 
 
 SM_OUTPUT_MAX = 14745
@@ -17,15 +25,24 @@ SM_STATUS_ERR = 3
 
 SM_STATUS_MASK = 0xC0
 
+SM_FRAME_SIZE = 4
+
 
-class SM9514(Thread):
+class SM9514(Sensor):
 
     def __init__(self,config):
         self.__parse_config(config)
 
-        self.__stop = Event()
+        self.__device = None
+
+        self.__window = None
+        self.__window_index = 0
+        self.__window_end = 0
 
-        super().__init__(target=self.__run)
+        self.__stale_counter = metrics.counter('sm9514_stale_total',topic=self.__topic)
+        self.__failure_counter = metrics.counter('sm9514_read_failures_total',topic=self.__topic)
+
+        super().__init__(self.__topic)
 
 
     def __parse_config(self,config):
@@ -33,8 +50,14 @@ class SM9514(Thread):
         self.__pmin = None
         self.__bus = None
         self.__addr = None
+        self.__frames = 1
         self.__topic = None
         self.__rate = None
+        self.__oversample = None
+        self.__deadband = None
+        self.__batch = False
+        self.__history = None
+        self.__timestamps = False
 
         if config is None or type(config) is not dict:
             raise TypeError('passed config is not of type dict')
@@ -72,25 +95,146 @@ class SM9514(Thread):
             raise ValueError('"addr" missing from the "i2c" object in the configuration')
         self.__addr = config['sm9514']['i2c']['addr']
 
+        if 'frames' in config['sm9514']['i2c']:
+            if config['sm9514']['i2c']['frames'] < 1:
+                raise ValueError('"frames" in the "i2c" object must be at least 1')
+            self.__frames = config['sm9514']['i2c']['frames']
+
+        if 'oversample' in config['sm9514']:
+            if not 'rate' in config['sm9514']['oversample']:
+                raise ValueError('"rate" missing from the "oversample" object in the configuration')
+            self.__oversample = config['sm9514']['oversample']['rate']
+
+        if 'deadband' in config['sm9514']:
+            self.__deadband = Deadband(config['sm9514']['deadband'])
+        else:
+            self.__deadband = Deadband(None)
+
+        if 'batch' in config['sm9514']:
+            self.__batch = config['sm9514']['batch']
+
+        if 'history' in config['sm9514']:
+            self.__history = History.get(self.__topic,config['sm9514']['history'])
+
+        if 'timestamps' in config['sm9514']:
+            self.__timestamps = config['sm9514']['timestamps']
 
-    def __run(self):
+
+    def setup(self) -> bool:
         logger.info(f'SM9514 started for topic \'{self.__topic}\' on i2c bus {self.__bus} addr {self.__addr}')
 
-        i2ch = Gpio.instance().i2c_open(self.__bus,self.__addr)
+        # Every frame is read back to back in a single transaction.
+        self.__device = I2cBus.instance().device(self.__bus,self.__addr,SM_FRAME_SIZE,self.__frames)
+
+        if self.__oversample is not None:
+            # Preallocate the window so sampling never allocates.
+            size = max(1,math.ceil(self.__oversample * self.__rate))
+            self.__window = array('H',bytes(2 * size))
+            self.__window_index = 0
+            self.__window_end = clock.monotonic() + self.__rate
+
+        if self.__history is not None:
+            self.__history.start()
+
+        return True
+
+
+    def step(self) -> float:
+        if self.__oversample is not None:
+            return self.__step_oversample()
+
+        valid, counts = self.__sm_read_pressure_counts()
+        acquired = self.acquired()
+        logger.debug('sm_read_pressure_counts -> %s %s',valid,counts)
+
+        if not valid:
+            return 0
+
+        pressure = float("""{0:2.3f}""".format(self.__sm_calculate_pressure(self.__pmax,self.__pmin,counts)))
+        if self.__history is not None:
+            self.__history.add(pressure,acquired[0])
+
+        if self.__deadband.check(pressure):
+            logger.info('%s: %s',self.__topic,pressure)
+            if self.__batch:
+                Mqtt.instance().sample(self.__topic,pressure,acquired[0])
+            elif self.__timestamps:
+                Mqtt.instance().publish(self.__topic,sample_payload(pressure,acquired),conflate=True)
+            else:
+                Mqtt.instance().publish(self.__topic,pressure,conflate=True)
+
+        return self.every(self.__rate)
 
-        while not self.__stop.is_set():
-            valid, counts = self.__sm_read_pressure_counts(gpio,i2ch)
-            logger.debug(f'sm_read_pressure_counts -> {valid} {counts}')
 
-            if valid:
-                pressure = float("""{0:2.3f}""".format(self.__sm_calculate_pressure(self.__pmax,self.__pmin,counts)))
-                logger.info(f'{self.__topic}: {pressure}')
-                Mqtt.instance().publish(self.__topic,pressure)
-                for _ in range(self.__rate):
-                    if self.__stop.wait(1):
-                        break
+    def __step_oversample(self) -> float:
+        valid, counts = self.__sm_read_pressure_counts()
+        acquired = self.acquired()
 
-        Gpio.instance().i2c_close(i2ch)
+        if valid:
+            self.__window[self.__window_index % len(self.__window)] = counts
+            self.__window_index += 1
+            if self.__batch:
+                Mqtt.instance().sample(self.__topic,self.__sm_calculate_pressure(self.__pmax,self.__pmin,counts),acquired[0])
+
+        # Windows are kept on a fixed grid like the samples.
+        if acquired[1] >= self.__window_end:
+            self.__publish_window(acquired)
+            self.__window_index = 0
+            self.__window_end += self.__rate
+            if self.__window_end <= acquired[1]:
+                self.__window_end = acquired[1] + self.__rate
+
+        return self.every(1.0 / self.__oversample)
+
+
+    def __publish_window(self,acquired):
+        count = min(self.__window_index,len(self.__window))
+        if count == 0:
+            logger.warning(f'{self.__topic}: no valid samples in window')
+            return
+
+        # Statistics are taken over the raw counts and converted once, the
+        # count to pressure conversion being linear.
+        window = self.__window[:count]
+        total = sum(window)
+        squares = sum(map(operator.mul,window,window))
+        variance = max(0,squares * count - total * total) / (count * count)
+        scale = abs(self.__pmax - self.__pmin) / (SM_OUTPUT_MAX - SM_OUTPUT_MIN)
+
+        low = self.__sm_calculate_pressure(self.__pmax,self.__pmin,min(window))
+        high = self.__sm_calculate_pressure(self.__pmax,self.__pmin,max(window))
+        stats = {
+            'mean': round(self.__sm_calculate_pressure(self.__pmax,self.__pmin,total / count),3),
+            'min': round(min(low,high),3),
+            'max': round(max(low,high),3),
+            'stddev': round(math.sqrt(variance) * scale,4),
+            'count': count
+        }
+        if self.__timestamps:
+            stats['time'] = round(acquired[0],3)
+            stats['monotonic'] = round(acquired[1],3)
+
+        if self.__history is not None:
+            self.__history.add(stats['mean'],acquired[0])
+
+        if not self.__deadband.check(stats['mean']):
+            return
+
+        logger.info('%s: %s',self.__topic,stats)
+        if self.__timestamps:
+            Mqtt.instance().publish(self.__topic,sample_payload(stats['mean'],acquired),conflate=True)
+        else:
+            Mqtt.instance().publish(self.__topic,stats['mean'],conflate=True)
+        Mqtt.instance().publish(self.__topic + '/stats',json.dumps(stats),conflate=True)
+
+
+    def teardown(self):
+        if self.__device is not None:
+            self.__device.close()
+            self.__device = None
+
+        if self.__history is not None:
+            self.__history.stop()
 
 
     def __sm_calculate_pressure(self,pmax,pmin,counts) -> float:
@@ -101,46 +245,51 @@ class SM9514(Thread):
         return (status & SM_STATUS_MASK) >> 6
 
 
-    def __sm_read_pressure_counts(self,gpio,i2ch) -> ():
+    def __sm_read_pressure_counts(self) -> ():
         read_tries = 3
         while read_tries > 0:
-            nbr, data = Gpio.instance().i2c_read_device(i2ch,4)
-            logger.debug(f'i2c_read_device -> {binascii.hexlify(data)}')
+            nbr, data = self.__device.read()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('i2c_read_device -> %s',binascii.hexlify(data))
 
-            if nbr != 4:
+            if nbr != SM_FRAME_SIZE * self.__frames:
                 logger.warning('Failed to read sensor.')
+                self.__failure_counter.inc()
                 return (False,0)
 
-            status = self.__sm_check_status(data[0])
-            logger.debug(f'sm_check_status -> {status}')
+            # A stale frame means the conversion is still in progress, the
+            # next frame may already have the new one.
+            for offset in range(0,nbr,SM_FRAME_SIZE):
+                status = self.__sm_check_status(data[offset])
+                logger.debug('sm_check_status -> %s',status)
 
-            if status == 3:
-                logger.warning('Device in error.')
-                return (False,0)
+                if status == 3:
+                    logger.warning('Device in error.')
+                    return (False,0)
 
-            if status == 1:
-                logger.warning('Device in command mode.')
-                return (False,0)
+                if status == 1:
+                    logger.warning('Device in command mode.')
+                    return (False,0)
 
-            if status == 0:
-                data[0] &= ~SM_STATUS_MASK
-                counts = int.from_bytes(data[0:2],byteorder='big')
-                if counts >= SM_OUTPUT_MIN and counts <= SM_OUTPUT_MAX:
-                    return (True,counts)
+                if status == 0:
+                    counts = ((data[offset] & ~SM_STATUS_MASK) << 8) | data[offset + 1]
+                    if counts >= SM_OUTPUT_MIN and counts <= SM_OUTPUT_MAX:
+                        return (True,counts)
 
-                logger.debug(f'Counts out of range: {counts}')
-                break
+                    logger.debug('Counts out of range: %s',counts)
+                    read_tries = 0
+                    break
 
-            if status == 2:
-                logger.debug('Conversion in progress.')
+                if status == 2:
+                    logger.debug('Conversion in progress.')
+                    self.__stale_counter.inc()
+
+            if read_tries == 0:
+                break
 
             read_tries -= 1
-            time.sleep(0.1)
+            clock.sleep(0.1)
 
         logger.error('Sensor did not return an answer.')
+        self.__failure_counter.inc()
         return (False,0)
-
-
-    def stop(self):
-        self.__stop.set()
-        self.join()
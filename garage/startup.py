@@ -0,0 +1,52 @@
+from .logger import logger
+from .metrics import metrics
+
+import time
+
+
+class StartupPhase():
+
+    def __init__(self,phases,name,depth):
+        self.__phases = phases
+        # The duration stays None while the phase is open.
+        self.__entry = [name,depth,None]
+
+
+    def __enter__(self):
+        self.__phases.append(self.__entry)
+        self.__start = time.perf_counter()
+        return self
+
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.__entry[2] = time.perf_counter() - self.__start
+
+
+# Records how long each phase of starting up took. The CPU time used before
+# this module was imported stands for the interpreter and the first imports.
+class Startup():
+
+    def __init__(self):
+        self.__interpreter = time.process_time()
+        self.__start = time.perf_counter()
+        self.__phases = []
+
+
+    # Phases opened inside another phase are reported nested within it.
+    def phase(self,name) -> StartupPhase:
+        return StartupPhase(self.__phases,name,len([entry for entry in self.__phases if entry[2] is None]))
+
+
+    def report(self):
+        total = self.__interpreter + time.perf_counter() - self.__start
+        logger.info(f'startup took {total:.3f} s')
+
+        metrics.gauge('startup_seconds',phase='interpreter').set(round(self.__interpreter,6))
+        logger.info(f'startup interpreter: {self.__interpreter * 1000:.1f} ms')
+        for name, depth, seconds in self.__phases:
+            metrics.gauge('startup_seconds',phase=name).set(round(seconds,6))
+            logger.info(f'startup {"  " * depth}{name}: {seconds * 1000:.1f} ms')
+        metrics.gauge('startup_seconds',phase='total').set(round(total,6))
+
+
+startup = Startup()
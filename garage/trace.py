@@ -0,0 +1,222 @@
+from .logger import logger
+from .clock import clock
+
+import pigpio
+
+from threading import Lock
+import struct
+
+
+TRACE_MAGIC = b'GTR1'
+
+# Magic and the wall clock time the trace was started.
+TRACE_HEADER = struct.Struct('<4sd')
+
+# Seconds since the start, kind, channel and the length of the data that
+# follows.
+TRACE_RECORD = struct.Struct('<dBHH')
+
+# Names a channel, the data being the name.
+TRACE_NAME = 0
+# A GPIO level, the channel being the pin and the data the level.
+TRACE_GPIO = 1
+# An I2C read, the channel being the bus and address and the data the bytes read.
+TRACE_I2C = 2
+# A DS18B20 reading, the channel being a named sensor id and the data a double.
+TRACE_W1 = 3
+
+TRACE_W1_VALUE = struct.Struct('<d')
+
+
+def i2c_channel(bus,addr) -> int:
+    return (bus << 7) | (addr & 0x7F)
+
+
+# The i2c_zip commands.
+I2C_ZIP_END = 0
+I2C_ZIP_ESCAPE = 1
+I2C_ZIP_ON = 2
+I2C_ZIP_OFF = 3
+I2C_ZIP_ADDRESS = 4
+I2C_ZIP_FLAGS = 5
+I2C_ZIP_READ = 6
+I2C_ZIP_WRITE = 7
+
+
+# Yields (addr, count) for every read of an i2c_zip command list, addr
+# starting as the address of the handle the commands are run on.
+def i2c_zip_reads(commands,addr):
+    index = 0
+    escaped = False
+    while index < len(commands) and commands[index] != I2C_ZIP_END:
+        cmd = commands[index]
+        index += 1
+        if cmd == I2C_ZIP_ESCAPE:
+            escaped = True
+            continue
+
+        if cmd in [I2C_ZIP_ADDRESS,I2C_ZIP_READ,I2C_ZIP_WRITE]:
+            param = commands[index]
+            index += 1
+            if escaped:
+                param |= commands[index] << 8
+                index += 1
+            if cmd == I2C_ZIP_ADDRESS:
+                addr = param
+            elif cmd == I2C_ZIP_READ:
+                yield (addr,param)
+            else:
+                index += param
+        elif cmd == I2C_ZIP_FLAGS:
+            index += 2
+        escaped = False
+
+
+# Yields (offset, kind, channel, data) for every record of a trace file.
+def read_trace(path):
+    with open(path,'rb') as f:
+        header = f.read(TRACE_HEADER.size)
+        if len(header) != TRACE_HEADER.size or TRACE_HEADER.unpack(header)[0] != TRACE_MAGIC:
+            raise ValueError(f'{path} is not a trace file')
+
+        while True:
+            record = f.read(TRACE_RECORD.size)
+            if len(record) != TRACE_RECORD.size:
+                return
+            offset, kind, channel, length = TRACE_RECORD.unpack(record)
+            data = f.read(length)
+            if len(data) != length:
+                # A trace cut short by a crash ends at its last whole record.
+                return
+            yield (offset,kind,channel,data)
+
+
+# Captures GPIO edges, I2C reads and DS18B20 readings into a trace file that
+# the replay backend feeds back to the sensors.
+class Recorder():
+    __instance = None
+
+
+    @staticmethod
+    def instance():
+        if Recorder.__instance is None:
+            raise Exception('Instance has not been created.')
+
+        return Recorder.__instance
+
+
+    # Unlike instance() this is cheap enough for the read paths to call on
+    # every read, returning None when nothing is being recorded.
+    @staticmethod
+    def active():
+        return Recorder.__instance
+
+
+    def __init__(self,config):
+        if Recorder.__instance is not None:
+            raise Exception('Singleton instance already created.')
+
+        self.__parse_config(config)
+
+        self.__lock = Lock()
+        self.__file = None
+        self.__start = None
+        self.__names = {}
+        self.__handles = {}
+        self.__callbacks = []
+
+        Recorder.__instance = self
+
+
+    def __parse_config(self,config):
+        self.__path = None
+        self.__pins = []
+
+        if config is not None and 'record' in config:
+            if not 'path' in config['record']:
+                raise ValueError('"path" missing from the "record" object in the configuration')
+            self.__path = config['record']['path']
+            if 'gpio' in config['record']:
+                if type(config['record']['gpio']) is not list:
+                    raise TypeError('"gpio" in the "record" object is not a list')
+                self.__pins = config['record']['gpio']
+
+
+    def __write(self,kind,channel,data,offset=None):
+        with self.__lock:
+            if self.__file is None:
+                return
+            if offset is None:
+                offset = clock.monotonic() - self.__start
+            self.__file.write(TRACE_RECORD.pack(offset,kind,channel,len(data)))
+            self.__file.write(data)
+
+
+    def __channel(self,name) -> int:
+        with self.__lock:
+            channel = self.__names.get(name)
+            if channel is not None:
+                return channel
+            channel = len(self.__names)
+            self.__names[name] = channel
+
+        self.__write(TRACE_NAME,channel,name.encode())
+        return channel
+
+
+    def __on_edge(self,pin,level,tick):
+        if level == pigpio.TIMEOUT:
+            return
+        self.__write(TRACE_GPIO,pin,bytes([level]))
+
+
+    def start(self,gpio):
+        logger.info(f'recording trace to {self.__path} for gpio {self.__pins}')
+
+        self.__file = open(self.__path,'wb')
+        self.__start = clock.monotonic()
+        self.__file.write(TRACE_HEADER.pack(TRACE_MAGIC,clock.time()))
+
+        for pin in self.__pins:
+            self.__callbacks.append(gpio.callback(pin,pigpio.EITHER_EDGE,self.__on_edge))
+        # The levels the edges start from, which a replay applies before
+        # the sensors start.
+        for pin in self.__pins:
+            self.__write(TRACE_GPIO,pin,bytes([gpio.read(pin)]),0.0)
+
+
+    def i2c_open(self,handle,bus,addr):
+        if handle >= 0:
+            self.__handles[handle] = (bus,addr)
+
+
+    def i2c_read(self,handle,count,data):
+        if handle in self.__handles and count > 0:
+            self.__write(TRACE_I2C,i2c_channel(*self.__handles[handle]),bytes(data))
+
+
+    # Records each read of the commands against the device it addressed.
+    def i2c_zip(self,handle,commands,count,data):
+        if not handle in self.__handles or count <= 0:
+            return
+
+        bus, addr = self.__handles[handle]
+        offset = 0
+        for addr, length in i2c_zip_reads(commands,addr):
+            self.__write(TRACE_I2C,i2c_channel(bus,addr),bytes(data[offset:offset + length]))
+            offset += length
+
+
+    def w1(self,sensor_id,value):
+        self.__write(TRACE_W1,self.__channel(sensor_id),TRACE_W1_VALUE.pack(value))
+
+
+    def stop(self):
+        for cb in self.__callbacks:
+            cb.cancel()
+        self.__callbacks = []
+
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
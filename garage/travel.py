@@ -0,0 +1,113 @@
+from .logger import logger
+from .atomic import atomic_write
+
+from collections import deque
+from threading import Lock
+import json
+import math
+
+
+TRAVEL_DIRECTIONS = ['opening','closing']
+
+
+# Learns how long a door takes to open and close from the transitions it
+# observes, so a stall is declared once travel runs past what the door
+# normally takes rather than after a fixed time.
+class TravelModel():
+
+    def __init__(self,config,default=30.0):
+        self.__parse_config(config)
+
+        self.__default = default
+        self.__lock = Lock()
+        self.__samples = {direction: deque(maxlen=self.__size) for direction in TRAVEL_DIRECTIONS}
+
+        if self.__path is not None:
+            self.__load()
+
+
+    def __parse_config(self,config):
+        self.__path = None
+        self.__size = 50
+        self.__minimum = 5
+        self.__percentile = 0.95
+        self.__margin = 1.5
+
+        if config is None:
+            return
+
+        if type(config) is not dict:
+            raise TypeError('"travel" is not of type dict')
+
+        if 'path' in config:
+            self.__path = config['path']
+
+        if 'samples' in config:
+            self.__size = config['samples']
+
+        if 'min_samples' in config:
+            self.__minimum = config['min_samples']
+
+        if 'percentile' in config:
+            if not 0 < config['percentile'] <= 1:
+                raise ValueError('"percentile" in the "travel" object must be in (0,1]')
+            self.__percentile = config['percentile']
+
+        if 'margin' in config:
+            self.__margin = config['margin']
+
+
+    def __load(self):
+        try:
+            with open(self.__path) as f:
+                samples = json.load(f)
+            for direction in TRAVEL_DIRECTIONS:
+                self.__samples[direction].extend(float(value) for value in samples.get(direction,[]))
+        except (OSError, ValueError, TypeError, AttributeError) as ex:
+            logger.info(f'travel model {self.__path} not loaded: {ex}')
+
+
+    def __store(self):
+        try:
+            atomic_write(self.__path,json.dumps({direction: list(samples) for direction, samples in self.__samples.items()}))
+        except OSError as ex:
+            logger.warning(f'travel model {self.__path} not stored: {ex}')
+
+
+    def __quantile(self,direction,q) -> float:
+        samples = sorted(self.__samples[direction])
+        if len(samples) < self.__minimum:
+            return None
+        return samples[min(len(samples) - 1,int(math.ceil(q * len(samples))) - 1)]
+
+
+    def observe(self,direction,seconds):
+        # Travel that outlasted the fixed window was a stall, not travel.
+        if seconds <= 0 or seconds > self.__default:
+            return
+
+        with self.__lock:
+            self.__samples[direction].append(round(seconds,3))
+            if self.__path is not None:
+                self.__store()
+
+
+    # Seconds of travel after which the door is considered stopped.
+    def limit(self,direction) -> float:
+        if not direction in self.__samples:
+            return self.__default
+
+        with self.__lock:
+            quantile = self.__quantile(direction,self.__percentile)
+        if quantile is None:
+            return self.__default
+        return min(self.__default,quantile * self.__margin)
+
+
+    # The typical travel time, or None until enough travel was observed.
+    def expected(self,direction) -> float:
+        if not direction in self.__samples:
+            return None
+
+        with self.__lock:
+            return self.__quantile(direction,0.5)
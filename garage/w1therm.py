@@ -1,30 +1,146 @@
 from .logger import logger
 from .mqtt import Mqtt, mqtt
+from .sensor import Sensor, sample_payload
+from .deadband import Deadband
+from .history import History
+from .trace import Recorder
+from .replay import Replay
+from .atomic import atomic_write
+from .clock import clock
 
 try:
     from w1thermsensor import W1ThermSensor
+    from w1thermsensor.errors import W1ThermSensorError
 except Exception as e:
     logger.warning('Cannot load w1thermsensor module')
 
-from threading import Thread, Event
+from threading import Lock
+import json
+import os
 import sys
+import time
 
 
-class W1Therm(Thread):
+W1_BULK_READ = '/sys/bus/w1/devices/w1_bus_master1/therm_bulk_read'
+
+# DS18B20 conversion time by resolution in bits.
+W1_CONVERSION_TIME = {9: 0.094, 10: 0.188, 11: 0.375, 12: 0.75}
+
+# Longest interval between searches of the bus for a missing probe.
+W1_RESOLVE_MAX = 600
+
+
+# Persistent sensor id to device directory cache, shared by every W1Therm
+# using the same file so restarts skip enumerating the bus.
+class W1PathCache():
+    __caches_lock = Lock()
+    __caches = {}
+
+
+    @staticmethod
+    def get(path):
+        with W1PathCache.__caches_lock:
+            if not path in W1PathCache.__caches:
+                W1PathCache.__caches[path] = W1PathCache(path)
+            return W1PathCache.__caches[path]
+
+
+    def __init__(self,path):
+        self.__path = path
+        self.__lock = Lock()
+        self.__devices = {}
+
+        try:
+            with open(path) as f:
+                self.__devices = json.load(f)
+        except (OSError, ValueError) as ex:
+            logger.info(f'w1 path cache {path} not loaded: {ex}')
+
+
+    def __store(self):
+        try:
+            atomic_write(self.__path,json.dumps(self.__devices))
+        except OSError as ex:
+            logger.warning(f'w1 path cache {self.__path} not stored: {ex}')
+
+
+    def lookup(self,sensor_id) -> str:
+        with self.__lock:
+            return self.__devices.get(sensor_id)
+
+
+    def update(self,sensor_id,device):
+        with self.__lock:
+            if self.__devices.get(sensor_id) == device:
+                return
+            self.__devices[sensor_id] = device
+            self.__store()
+
+
+    def remove(self,sensor_id):
+        with self.__lock:
+            if self.__devices.pop(sensor_id,None) is not None:
+                self.__store()
+
+
+class W1Therm(Sensor):
 
     def __init__(self,config):
         self.__parse_config(config)
 
-        self.__stop = Event()
+        self.__cache = None
+        self.__resolve_time = 0
+        self.__resolve_interval = None
+
+        super().__init__(self.__probes[0]['topic'])
+
+
+    def __parse_probe_config(self,config,name,topic,deadband,history) -> dict:
+        if type(config) is not dict:
+            raise TypeError(f'Invalid (not a dict) type found in "{name}"')
+
+        if not 'id' in config:
+            raise ValueError(f'"id" missing from the "{name}" object in the configuration')
+
+        if not 'offset' in config:
+            raise ValueError(f'"offset" missing from the "{name}" object in the configuration')
+
+        if 'topic' in config:
+            topic = config['topic']
+        if topic is None:
+            raise ValueError(f'"topic" missing from the "{name}" object in the configuration')
+
+        if 'deadband' in config:
+            deadband = config['deadband']
 
-        super().__init__(target=self.__run)
+        if 'history' in config:
+            history = config['history']
+
+        resolution = None
+        if 'resolution' in config:
+            if not config['resolution'] in W1_CONVERSION_TIME:
+                raise ValueError(f'"resolution" in the "{name}" object must be one of {list(W1_CONVERSION_TIME)}')
+            resolution = config['resolution']
+
+        return {
+            'id': config['id'],
+            'offset': config['offset'],
+            'topic': topic,
+            'deadband': Deadband(deadband),
+            'history': History.get(topic,history) if history is not None else None,
+            'resolution': resolution,
+            'sensor': None
+        }
 
 
     def __parse_config(self,config):
-        self.__sensor_id = None
-        self.__offset = None
+        self.__probes = []
         self.__topic = None
         self.__rate = None
+        self.__batch = False
+        self.__bulk = W1_BULK_READ
+        self.__cache_path = None
+        self.__timestamps = False
 
         if config is None or type(config) is not dict:
             raise TypeError('passed config is not of type dict')
@@ -32,52 +148,219 @@ class W1Therm(Thread):
         if not 'w1therm' in config:
             raise ValueError('"w1therm" object missing from the confiugration')
 
-        if not 'topic' in config['w1therm']:
-            raise ValueError('"topic" missing from the configuration')
-        self.__topic = config['w1therm']['topic']
+        if 'topic' in config['w1therm']:
+            self.__topic = config['w1therm']['topic']
 
         if not 'rate' in config['w1therm']:
             raise ValueError('"rate" missing from the configuration')
         self.__rate = config['w1therm']['rate']
 
-        if not 'sensor' in config['w1therm']:
+        deadband = None
+        if 'deadband' in config['w1therm']:
+            deadband = config['w1therm']['deadband']
+
+        history = None
+        if 'history' in config['w1therm']:
+            history = config['w1therm']['history']
+
+        if 'sensors' in config['w1therm']:
+            if type(config['w1therm']['sensors']) is not list:
+                raise TypeError('"sensors" is not a list')
+            for item in config['w1therm']['sensors']:
+                self.__probes.append(self.__parse_probe_config(item,'sensors',None,deadband,history))
+        elif 'sensor' in config['w1therm']:
+            if self.__topic is None:
+                raise ValueError('"topic" missing from the configuration')
+            self.__probes.append(self.__parse_probe_config(config['w1therm']['sensor'],'sensor',self.__topic,deadband,history))
+        else:
             raise ValueError('"sensor" object missing from the configuration')
 
-        if not 'id' in config['w1therm']['sensor']:
-            raise ValueError('"id" missing from the "sensor" object in the configuration')
-        self.__sensor_id = config['w1therm']['sensor']['id']
+        if 'batch' in config['w1therm']:
+            self.__batch = config['w1therm']['batch']
 
-        if not 'offset' in config['w1therm']['sensor']:
-            raise ValueError('"offset" missing from the "sensor" object in the configuration')
-        self.__offset = config['w1therm']['sensor']['offset']
+        if 'bulk' in config['w1therm']:
+            self.__bulk = config['w1therm']['bulk']
 
+        if 'cache' in config['w1therm']:
+            self.__cache_path = config['w1therm']['cache']
 
-    def __run(self):
-        logger.info(f'W1Therm started for topic \'{self.__topic}\' for sensor id {self.__sensor_id}')
+        if 'timestamps' in config['w1therm']:
+            self.__timestamps = config['w1therm']['timestamps']
 
-        if not 'w1thermsensor' in sys.modules:
+
+    def setup(self) -> bool:
+        logger.info(f'W1Therm started for sensor ids {[probe["id"] for probe in self.__probes]}')
+
+        if not 'w1thermsensor' in sys.modules and not Replay.enabled():
             logger.warning('w1thermsensor module did not load, exiting')
+            return False
+
+        if self.__cache_path is not None and not Replay.enabled():
+            self.__cache = W1PathCache.get(self.__cache_path)
+
+        self.__resolve(self.__probes)
+        self.__resolve_interval = self.__rate
+        self.__resolve_time = clock.monotonic() + self.__resolve_interval
+
+        if not [probe for probe in self.__probes if probe['sensor'] is not None]:
+            logger.warning('No sensors are detected, exiting')
+            return False
+
+        for probe in self.__probes:
+            if probe['history'] is not None:
+                probe['history'].start()
+
+        return True
+
+
+    def teardown(self):
+        for probe in self.__probes:
+            if probe['history'] is not None:
+                probe['history'].stop()
+
+
+    def __from_cache(self,probe) -> object:
+        if self.__cache is None:
+            return None
+
+        device = self.__cache.lookup(probe['id'])
+        if device is None:
+            return None
+
+        try:
+            return W1ThermSensor(W1ThermSensor.RESOLVE_TYPE_STR[device[:2]],probe['id'])
+        except (KeyError, W1ThermSensorError):
+            logger.info(f'Cached device {device} for sensor {probe["id"]} is stale')
+            self.__cache.remove(probe['id'])
+            return None
+
+
+    # Probes not in the cache cost a single enumeration of the bus.
+    def __resolve(self,probes):
+        if Replay.enabled():
+            for probe in probes:
+                probe['sensor'] = Replay.instance().w1_sensor(probe['id'])
             return
 
-        sensor = None
-        for _sensor in W1ThermSensor.get_available_sensors():
-            if _sensor.id == self.__sensor_id:
-                sensor = _sensor
-                break
-        
-        if sensor is None:
-            logger.warning(f'Sensor {self.__sensor_id} is not detected, exiting')
+        missing = []
+        for probe in probes:
+            probe['sensor'] = self.__from_cache(probe)
+            if probe['sensor'] is None:
+                missing.append(probe)
+
+        if missing:
+            sensors = {_sensor.id: _sensor for _sensor in W1ThermSensor.get_available_sensors()}
+            for probe in missing:
+                if not probe['id'] in sensors:
+                    logger.warning(f'Sensor {probe["id"]} is not detected')
+                    continue
+                probe['sensor'] = sensors[probe['id']]
+                if self.__cache is not None:
+                    self.__cache.update(probe['id'],probe['sensor'].slave_prefix + probe['id'])
+
+        for probe in probes:
+            if probe['sensor'] is not None and probe['resolution'] is not None:
+                self.__set_resolution(probe)
+
+
+    # Every search for a missing probe enumerates the bus, so while one stays
+    # missing the searches back off, doubling the interval up to a maximum.
+    def __resolve_missing(self):
+        missing = [probe for probe in self.__probes if probe['sensor'] is None]
+        if not missing or clock.monotonic() < self.__resolve_time:
             return
 
-        while not self.__stop.is_set():
-            temp = """{0:5.1f}""".format(sensor.get_temperature(unit=W1ThermSensor.DEGREES_F) + self.__offset)
-            logger.info(f'{self.__sensor_id} {self.__topic} {temp}')
-            Mqtt.instance().publish(self.__topic,temp)
-            for _ in range(self.__rate):
-                if self.__stop.wait(1):
-                    break
+        self.__resolve(missing)
+        if [probe for probe in missing if probe['sensor'] is None]:
+            self.__resolve_interval = min(self.__resolve_interval * 2,W1_RESOLVE_MAX)
+        else:
+            self.__resolve_interval = self.__rate
+        self.__resolve_time = clock.monotonic() + self.__resolve_interval
+
+
+    def __set_resolution(self,probe):
+        # Written directly rather than through set_resolution() which
+        # spawns a shell for every write.
+        try:
+            with open(probe['sensor'].sensorpath,'w') as f:
+                f.write(f'{probe["resolution"]}\n')
+        except OSError as ex:
+            logger.warning(f'Cannot set resolution of sensor {probe["id"]}: {ex}')
+
+
+    def __conversion_time(self) -> float:
+        return max(W1_CONVERSION_TIME[probe['resolution'] or 12] for probe in self.__probes)
+
+
+    # Starts a conversion on every probe on the bus at once. Once it is done
+    # each probe returns its converted value without a conversion of its own.
+    def __bulk_convert(self) -> bool:
+        if self.__bulk is None or Replay.enabled() or not os.path.exists(self.__bulk):
+            return False
+
+        try:
+            with open(self.__bulk,'w') as f:
+                f.write('trigger\n')
+
+            deadline = time.monotonic() + self.__conversion_time() * 2
+            while time.monotonic() < deadline:
+                with open(self.__bulk) as f:
+                    # -1 is a conversion in progress, 1 is results pending a read.
+                    if int(f.read()) != -1:
+                        return True
+                time.sleep(0.05)
+        except (OSError, ValueError) as ex:
+            logger.warning(f'bulk conversion failed: {ex}')
+            return False
+
+        logger.warning('bulk conversion timed out')
+        return False
+
+
+    # Replayed sensors return None until the trace has a reading for them.
+    def __temperature(self,probe) -> float:
+        if Replay.enabled():
+            return probe['sensor'].get_temperature()
+        return probe['sensor'].get_temperature(unit=W1ThermSensor.DEGREES_F)
+
+
+    def step(self) -> float:
+        self.__resolve_missing()
+
+        self.__bulk_convert()
+
+        for probe in self.__probes:
+            if probe['sensor'] is None:
+                continue
+
+            try:
+                value = self.__temperature(probe)
+            except W1ThermSensorError as ex:
+                logger.warning(f'Sensor {probe["id"]} failed: {ex}')
+                probe['sensor'] = None
+                if self.__cache is not None:
+                    self.__cache.remove(probe['id'])
+                continue
+
+            if value is None:
+                continue
+            acquired = self.acquired()
+
+            if Recorder.active() is not None:
+                Recorder.active().w1(probe['id'],value)
+
+            temp = """{0:5.1f}""".format(value + probe['offset'])
+            if probe['history'] is not None:
+                probe['history'].add(float(temp),acquired[0])
 
+            if probe['deadband'].check(float(temp)):
+                logger.info('%s %s %s',probe['id'],probe['topic'],temp)
+                if self.__batch:
+                    Mqtt.instance().sample(probe['topic'],float(temp),acquired[0])
+                elif self.__timestamps:
+                    Mqtt.instance().publish(probe['topic'],sample_payload(float(temp),acquired),conflate=True)
+                else:
+                    Mqtt.instance().publish(probe['topic'],temp,conflate=True)
 
-    def stop(self):
-        self.__stop.set()
-        self.join()
+        # The bulk conversion is part of the period rather than added to it.
+        return self.every(self.__rate)